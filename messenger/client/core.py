@@ -2,7 +2,12 @@ import socket
 import json
 import logging
 import ftplib
+import time
+import queue
+import random
+import itertools
 import threading
+from concurrent.futures import Future
 from datetime import datetime
 from io import BytesIO
 from typing import Dict
@@ -18,6 +23,13 @@ from observers import (
 
 logger = logging.getLogger('client_logger')
 
+# every request and response is one json document followed by newline
+FRAME_END = b'\n'
+
+# codes of responses to messages which are sent again (rate limit,
+# server busy, deadline)
+RETRY_CODES = (429, 503, 504)
+
 
 class SingletonMeta(type):
     """Singleton realisation with metaclass"""
@@ -46,31 +58,195 @@ class Status(Singleton):
                 setattr(self, key, str(value))
 
 
+class PendingRequests:
+    """
+    Table of requests waiting for responses: {request id: (future,
+    expiration time)}. Future gets response with the same request id,
+    futures of expired requests get TimeoutError.
+    """
+
+    def __init__(self) -> None:
+        self.requests: Dict = {}
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, timeout: float):
+        """Returns new request id and future of its response"""
+
+        request_id = next(self.counter)
+        future = Future()
+
+        with self.lock:
+            self.requests[request_id] = (future, time.monotonic() + timeout)
+        return request_id, future
+
+    def resolve(self, response: Dict) -> bool:
+        """Sets response to future of its request if it is waited"""
+
+        with self.lock:
+            pending = self.requests.pop(response.get('request_id'), None)
+
+        if pending:
+            pending[0].set_result(response)
+        self.expire()
+        return bool(pending)
+
+    def expire(self) -> None:
+        now = time.monotonic()
+
+        with self.lock:
+            expired = [
+                request_id
+                for request_id, (future, expires) in self.requests.items()
+                if expires < now
+            ]
+            futures = [self.requests.pop(key)[0] for key in expired]
+
+        for future in futures:
+            future.set_exception(TimeoutError('Response timeout'))
+
+    def fail(self, error: Exception) -> None:
+        """Fails all waiting requests (connection is lost)"""
+
+        with self.lock:
+            futures = [future for future, _ in self.requests.values()]
+            self.requests.clear()
+
+        for future in futures:
+            future.set_exception(error)
+
+
+class Session:
+    """
+    State needed to restore user session on new connection: session
+    token, last chat request and new messages not added by server
+    yet {request id: (action, user data)}. Messages are kept until
+    server answers them with code 200, also when session expires and
+    user logs in again. Messages answered with RETRY_CODES are sent
+    again, messages rejected by server are dropped.
+    """
+
+    def __init__(self) -> None:
+        self.token = None
+        self.username = None
+        self.chat = None
+        self.messages: Dict = {}
+        # number of retries of messages {request id: attempts}
+        self.attempts: Dict = {}
+        self.lock = threading.Lock()
+
+    def request(self, action: str, user_data: Dict, request_id):
+        """Remembers sent request if it is needed for restoring"""
+
+        if action in ('get_chat', 'common_chat'):
+            # requests of older pages (with limit) are not repeated
+            if 'limit' not in user_data:
+                self.chat = (action, user_data)
+
+        elif action == 'add_message':
+            with self.lock:
+                self.messages[request_id] = (action, user_data)
+
+        elif action == 'logout':
+            self.token = self.chat = None
+            with self.lock:
+                self.messages.clear()
+                self.attempts.clear()
+
+    def update(self, response: Dict) -> None:
+        """Updates session by response"""
+
+        action = response.get('action')
+
+        if action in ('login', 'resume'):
+            if response.get('code') == 200:
+                username = response['user_data'].get('username')
+                if username and self.username not in (None, username):
+                    # messages of other user are not sent
+                    self.chat = None
+                    with self.lock:
+                        self.messages.clear()
+                        self.attempts.clear()
+
+                self.username = username or self.username
+                self.token = response['user_data'].get('token')
+            elif action == 'resume':
+                self.token = None
+
+    def answer(self, response: Dict):
+        """
+        Settles message by response to it. Returns 'retry' if message
+        must be sent again, 'failed' (message is dropped) if server
+        rejected it or None.
+        """
+
+        request_id = response.get('request_id')
+        code = response.get('code')
+
+        with self.lock:
+            if request_id not in self.messages:
+                return None
+
+            if code in RETRY_CODES:
+                attempts = self.attempts.get(request_id, 0) + 1
+                if attempts <= settings.RETRY_ATTEMPTS:
+                    self.attempts[request_id] = attempts
+                    return 'retry'
+
+            self.messages.pop(request_id)
+            self.attempts.pop(request_id, None)
+
+        return None if code == 200 else 'failed'
+
+    def message(self, request_id):
+        with self.lock:
+            return self.messages.get(request_id)
+
+    def unanswered(self):
+        with self.lock:
+            return list(self.messages.items())
+
+
 class Sender:
     """
-    Prepares request and then opens thread and sends
-    request within this thread.
+    Prepares request and puts it to client outbound queue,
+    request is sent by client writer thread.
     """
 
     def __init__(self, client):
         self.client = client
 
-    def send_request(self, action: str = None, user_data: Dict = {}) -> None:
+    def send_request(
+            self, action: str = None, user_data: Dict = {}
+    ) -> Future:
+        """
+        Sends request, returns future of response, future gets
+        TimeoutError if there is no response in REQUEST_TIMEOUT seconds
+        """
+
+        request_id, future = self.client.pending.add(settings.REQUEST_TIMEOUT)
+
+        self.client.session.request(action, user_data, request_id)
+        self.resend(request_id, action, user_data)
+        return future
 
+    def resend(self, request_id, action: str, user_data: Dict) -> None:
+        """Sends request with given id, request gets new timeout"""
+
+        now = datetime.now().timestamp()
         data = {
             'action': action,
-            'time': datetime.now().timestamp(),
+            'id': request_id,
+            'time': now,
+            'timeout': settings.REQUEST_TIMEOUT,
             'data': user_data
         }
 
-        raw_data = json.dumps(data).encode(
-            self.client.settings.encoding_name
-        )
-
-        send_thread = threading.Thread(
-            target=self.client.send_request, args=(raw_data,)
+        self.client.send_request(
+            json.dumps(data).encode(
+                self.client.settings.encoding_name
+            ) + FRAME_END
         )
-        send_thread.start()
 
 
 class PortDescriptor:
@@ -214,60 +390,225 @@ class FtpClient(Singleton):
 
 
 class Client(metaclass=ClientVerifier):
+    """
+    Keeps connection with server. Lost connection is opened again
+    with growing random delay, then session is resumed with token
+    given by login, active chat is requested again and new messages
+    which were not answered by server are sent again.
+    """
 
     state = False
+    # incremented by every connect and close call, loop of previous
+    # connect call stops when generation is changed
+    generation = 0
 
     def __init__(self, namespace: Namespace = None):
         self.notifier = BaseNotifier(self)
         self.status = Status(self.notifier)
         self.settings = Settings()
+        # frames waiting for writer thread, None stops it
+        self.outbox = queue.Queue()
+        self.pending = PendingRequests()
+        self.session = Session()
 
     def make_socket(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         return sock
 
     def connect(self):
-        try:
-            self.socket = self.make_socket()
-            self.socket.connect((self.settings.host, self.settings.port))
-            logger.info('Connection with server established')
+        """
+        Connects to server and reads responses until client is closed,
+        connection is opened again when it is lost (RECONNECT setting)
+        """
+
+        self.generation += 1
+        generation = self.generation
+        delay = settings.RECONNECT_DELAY_MIN
+
+        while generation == self.generation:
+            opened = time.monotonic()
+
+            try:
+                self.open()
+                self.get_response()
+            except Exception as error:
+                self.state = False
+                self.notifier.notify('state')
+                logger.error(error, exc_info=True)
+                print('Connection failed')
+
+            if not settings.RECONNECT or generation != self.generation:
+                return
+
+            if time.monotonic() - opened > settings.RECONNECT_DELAY_MAX:
+                delay = settings.RECONNECT_DELAY_MIN
+
+            # random delay spreads reconnections of many clients
+            # after server restart
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, settings.RECONNECT_DELAY_MAX)
+
+    def open(self):
+        self.socket = self.make_socket()
+        self.socket.connect((self.settings.host, self.settings.port))
+        # server pings idle connections, so long silence means
+        # that connection is lost
+        self.socket.settimeout(settings.HEARTBEAT_TIMEOUT)
+        logger.info('Connection with server established')
+
+        # every connection has own queue and writer thread
+        self.outbox = queue.Queue()
+        self.writer = threading.Thread(
+            target=self.write_frames, args=(self.outbox, self.socket),
+            name='writer', daemon=True
+        )
 
-            self.state = True
-            self.notifier.notify('state')
-            self.get_response()
+        self.state = True
+        self.writer.start()
+        self.notifier.notify('state')
 
-        except Exception as error:
-            self.state = False
-            self.notifier.notify('state')
-            logger.error(error, exc_info=True)
-            print('Connection failed')
+        if self.session.token:
+            Sender(self).send_request(
+                action='resume', user_data={'token': self.session.token}
+            )
 
     def get_response(self):
+        buffer = b''
 
         while self.state:
             try:
                 raw_response = self.socket.recv(self.settings.buffer_size)
-                if raw_response:
-                    response = json.loads(
-                        json.loads(
-                            raw_response.decode(self.settings.encoding_name)
-                        )
-                    )
+                if not raw_response:
+                    raise ConnectionError('Connection closed by server')
+
+                buffer += raw_response
+                *frames, buffer = buffer.split(FRAME_END)
 
-                    self.notifier.notify('response', **response)
+                for frame in frames:
+                    if frame:
+                        self.handle_response(frame)
             except Exception as error:
                 self.state = False
+                self.outbox.put(None)
+                self.socket.close()
+                self.pending.fail(ConnectionError('Connection lost'))
                 self.notifier.notify('state')
                 raise error
 
+    def handle_response(self, frame):
+        response = json.loads(
+            json.loads(frame.decode(self.settings.encoding_name))
+        )
+
+        if response.get('action') == 'ping':
+            self.send_request(self.pong)
+            self.pending.expire()
+            return
+
+        self.pending.resolve(response)
+        self.session.update(response)
+        outcome = self.session.answer(response)
+
+        if outcome == 'retry':
+            self.retry_later(response.get('request_id'))
+        elif outcome == 'failed':
+            self.notifier.notify('failed', **response)
+
+        restored = response.get('action') in ('login', 'resume') and (
+            response.get('code') == 200
+        )
+        if restored:
+            self.restore_session()
+
+        self.notifier.notify('response', **response)
+
+    def restore_session(self):
+        """Requests active chat and sends not answered messages again"""
+
+        sender = Sender(self)
+
+        if self.session.chat:
+            sender.send_request(*self.session.chat)
+
+        for request_id, (action, user_data) in self.session.unanswered():
+            sender.resend(request_id, action, user_data)
+
+    def retry_later(self, request_id):
+        """Sends message again after growing random delay"""
+
+        attempts = self.session.attempts.get(request_id, 1)
+        delay = min(
+            settings.RETRY_DELAY_MAX,
+            settings.RETRY_DELAY_MIN * 2 ** (attempts - 1)
+        )
+        timer = threading.Timer(
+            random.uniform(delay / 2, delay), self.retry, (request_id,)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def retry(self, request_id):
+        # lost connection sends messages again after resuming session
+        message = self.session.message(request_id)
+        if message and self.state:
+            Sender(self).resend(request_id, *message)
+
+    @property
+    def pong(self):
+        return json.dumps(
+            {'action': 'pong', 'time': datetime.now().timestamp(), 'data': {}}
+        ).encode(self.settings.encoding_name) + FRAME_END
+
     def send_request(self, request):
+        """Puts request frame to outbound queue, can be called by any thread"""
 
         if self.state:
+            self.outbox.put(request)
+
+    def write_frames(self, outbox, sock):
+        """
+        Writer thread: takes frames from outbound queue in order and
+        sends all frames waiting at the moment with one 'sendall',
+        so requests are never interleaved.
+        """
+
+        while True:
+            frames = [outbox.get()]
+            size = len(frames[0] or b'')
+
+            while frames[-1] is not None and size < self.settings.buffer_size:
+                try:
+                    frames.append(outbox.get_nowait())
+                except queue.Empty:
+                    break
+                size += len(frames[-1] or b'')
+
+            stop = frames[-1] is None
+            data = b''.join(frame for frame in frames if frame)
+
             try:
-                self.socket.send(request)
-            except Exception as error:
+                if data:
+                    sock.sendall(data)
+            except OSError as error:
                 logger.error(error, exc_info=True)
-                raise error
+                # wakes up reading thread, it handles lost connection
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+            if stop:
+                return
 
     def close(self):
-        self.socket.close()
+        self.generation += 1
+        self.state = False
+        self.outbox.put(None)
+        if hasattr(self, 'socket'):
+            # wakes up reading thread blocked in 'recv'
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
@@ -1,5 +1,6 @@
 import sys
 import os
+import uuid
 import threading
 from typing import Dict
 from io import BytesIO
@@ -14,14 +15,15 @@ from PyQt5.QtWidgets import (
     QLabel,
     QLineEdit,
     QPushButton,
-    QTextEdit,
+    QListView,
     QHBoxLayout,
     QVBoxLayout,
     QGroupBox,
     QColumnView,
     QToolBar,
     QAction,
-    QFileDialog
+    QFileDialog,
+    QMessageBox
 )
 from PyQt5.QtGui import (
     QPixmap,
@@ -32,6 +34,9 @@ from PyQt5.QtCore import (
     Qt,
     QThread,
     QStringListModel,
+    QAbstractListModel,
+    QModelIndex,
+    QTimer,
     pyqtSignal
 )
 
@@ -53,10 +58,15 @@ from observers import (
     NewMessageListener,
     ProfileListener,
     AvatarListener,
-    SearchMessageListener
+    SearchMessageListener,
+    SyncListener,
+    DeliveryListener,
+    SessionExpiredListener,
+    MessageFailedListener
 )
 
 import settings
+from store import MessageStore
 
 
 class ClientThread(QThread):
@@ -147,6 +157,75 @@ class FormFactory(QFormLayout):
             self.addRow(QLabel(field.replace('_', ' ').title()), line_edit)
 
 
+class MessagesModel(QAbstractListModel):
+    """
+    Loaded messages (seq, sender, text) of active chat. List view
+    renders only visible rows, so long chats are shown at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+        self.last_seq = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            seq, sender, text = self.messages[index.row()]
+            # sender or message could be deleted
+            return '{}: {}'.format(
+                sender or 'deleted user', text if text is not None else ''
+            )
+
+    @property
+    def first_seq(self):
+        """Seq of first loaded message (0 - there are no older ones)"""
+
+        return self.messages[0][0] or 0 if self.messages else 0
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self.messages = list(messages)
+        self.last_seq = max(
+            [message[0] or 0 for message in self.messages] or [0]
+        )
+        self.endResetModel()
+
+    def append(self, messages):
+        """Adds new messages, messages loaded already are skipped"""
+
+        messages = [
+            message for message in messages
+            if not message[0] or message[0] > self.last_seq
+        ]
+        if messages:
+            self.beginInsertRows(
+                QModelIndex(),
+                len(self.messages),
+                len(self.messages) + len(messages) - 1
+            )
+            self.messages.extend(messages)
+            self.last_seq = max(
+                [self.last_seq] + [message[0] or 0 for message in messages]
+            )
+            self.endInsertRows()
+
+    def prepend(self, messages):
+        """Adds older messages, returns number of added ones"""
+
+        messages = [
+            message for message in messages
+            if message[0] < self.first_seq
+        ]
+        if messages:
+            self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+            self.messages[:0] = messages
+            self.endInsertRows()
+        return len(messages)
+
+
 class StatusGroup(QGroupBox):
     """
     Custom 'group box' widget.
@@ -584,12 +663,16 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
 
     update_model_add = pyqtSignal(dict)
     update_model_delete = pyqtSignal(str)
-    append_messages_to_textbox = pyqtSignal(list)
     append_message_to_textbox = pyqtSignal(dict)
     set_searched_messages = pyqtSignal(list)
     set_avatar_signal = pyqtSignal(str)
     open_chat = pyqtSignal(dict)
     open_profile = pyqtSignal(dict)
+    store_message = pyqtSignal(dict)
+    sync_chats = pyqtSignal(dict)
+    receive_deliveries = pyqtSignal(dict)
+    session_expired = pyqtSignal()
+    message_failed = pyqtSignal(dict)
 
     active_chat: int
     messages_lenght: int
@@ -609,29 +692,65 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
         self.search_message_listener = SearchMessageListener(
             self, self.client.notifier
         )
+        self.sync_listener = SyncListener(self, self.client.notifier)
+        self.delivery_listener = DeliveryListener(self, self.client.notifier)
+        self.session_expired_listener = SessionExpiredListener(
+            self, self.client.notifier
+        )
+        self.message_failed_listener = MessageFailedListener(
+            self, self.client.notifier
+        )
 
         self.update_model_add.connect(self.update_contacts_list_add)
         self.update_model_delete.connect(self.update_contacts_list_delete)
-        self.append_messages_to_textbox.connect(self.append_messages)
         self.append_message_to_textbox.connect(self.append_message)
         self.set_avatar_signal.connect(self.set_avatar)
         self.open_chat.connect(self.activate_chat)
         self.open_profile.connect(self.profile_dialog)
         self.set_searched_messages.connect(self.set_messages)
+        self.store_message.connect(self.save_message)
+        self.sync_chats.connect(self.sync)
+        self.receive_deliveries.connect(self.show_deliveries)
+        self.session_expired.connect(self.expire_session)
+        self.message_failed.connect(self.show_failed_message)
 
         self.add_contact_window = AddContact(client=self.client, parent=self)
 
         self.init_ui()
         self.chats_data = {}
+        self.active_chat = None
+        # session was not resumed, user must log in again
+        self.expired = False
+        # contact username of active chat or 'common'
+        self.active_key = None
+        # older messages are requested from server
+        self.loading = False
+        # not read private messages {chat_id: count} and chat names
+        self.unread = {}
+        self.chat_names = {}
+        # read messages {chat_id: seq} waiting for acknowledgement
+        self.acks = {}
+        self.ack_timer = QTimer(self)
+        self.ack_timer.setSingleShot(True)
+        self.ack_timer.setInterval(int(settings.ACK_DELAY * 1000))
+        self.ack_timer.timeout.connect(self.send_acks)
 
     def __call__(self, kwargs):
         self.username = kwargs.get('user_data').get('username')
         self.user_label.setText(f'{self.username}')
         self.user_id = kwargs.get('user_data').get('user_id')
         self.contacts = kwargs.get('user_data').get('contacts')
+        self.token = kwargs.get('user_data').get('token')
+        self.store = MessageStore.for_account(
+            settings.STORE_DIR,
+            self.client.settings.host,
+            self.client.settings.port,
+            self.username
+        )
         self.init_model(self.contacts.keys())
         self.column_view.setModel(self.model)
         self.show()
+        self.sync({'action': 'login'})
 
     def init_model(self, contacts):
         if hasattr(self, 'model'):
@@ -694,6 +813,10 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
         v_contacts_layout = QVBoxLayout()
         v_contacts_layout.addWidget(lbl_contacts)
         v_contacts_layout.addWidget(self.column_view)
+
+        self.unread_label = QLabel()
+        self.unread_label.setWordWrap(True)
+        v_contacts_layout.addWidget(self.unread_label)
         v_contacts_layout.addWidget(btn_common_chat)
         v_contacts_layout.addWidget(btn_add_contact)
         v_contacts_layout.addWidget(btn_delete_contact)
@@ -716,9 +839,14 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
         h_search_layout.addWidget(self.search_message)
         h_search_layout.addWidget(search_message_toolbar)
 
-        self.chat_text_edit = QTextEdit()
-        self.chat_text_edit.setReadOnly(True)
-        self.chat_text_edit.setDisabled(True)
+        self.messages_model = MessagesModel()
+        self.chat_view = QListView()
+        self.chat_view.setModel(self.messages_model)
+        self.chat_view.setWordWrap(True)
+        self.chat_view.setDisabled(True)
+        self.chat_view.verticalScrollBar().valueChanged.connect(
+            self.chat_scrolled
+        )
 
         lbl_enter = QLabel('Enter message')
         self.message_line_edit = QLineEdit()
@@ -746,7 +874,7 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
         v_chat_layout = QVBoxLayout()
         # v_chat_layout.addWidget(toolbar)
         v_chat_layout.addLayout(h_search_layout)
-        v_chat_layout.addWidget(self.chat_text_edit)
+        v_chat_layout.addWidget(self.chat_view)
         v_chat_layout.addWidget(lbl_enter)
         v_chat_layout.addWidget(self.message_line_edit)
 
@@ -777,26 +905,24 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
 
     def set_messages(self, messages):
         if messages:
-            self.chat_text_edit.clear()
-            for message in messages:
-                self.chat_text_edit.append(
-                    '{}: {}'.format(message[0], message[1])
-                )
+            self.messages_model.set_messages(
+                [(None, sender, text) for sender, text in messages]
+            )
 
     def action_bold(self):
         myFont = QFont()
         myFont.setBold(True)
-        self.chat_text_edit.setFont(myFont)
+        self.chat_view.setFont(myFont)
 
     def action_italic(self):
         myFont = QFont()
         myFont.setItalic(True)
-        self.chat_text_edit.setFont(myFont)
+        self.chat_view.setFont(myFont)
 
     def action_underlined(self):
         myFont = QFont()
         myFont.setUnderline(True)
-        self.chat_text_edit.setFont(myFont)
+        self.chat_view.setFont(myFont)
 
     def set_avatar(self, path):
         avatar_thread = threading.Thread(target=self.fetch_ftp, args=(path,))
@@ -829,47 +955,236 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
         )
 
     def send_chat_request(self, item):
-        user_data = {
-            'user_id': self.user_id,
-            'contact_id': self.contacts.get(item.data()),
-            'username': self.username
-        }
-        self._sender.send_request(action='get_chat', user_data=user_data)
+        self.request_chat(item.data(), self.show_stored_chat(item.data()))
 
     def send_common_chat_request(self):
-        self._sender.send_request(
-            action='common_chat', user_data={'username': self.username}
+        self.request_chat('common', self.show_stored_chat('common'))
+
+    def request_chat(self, key, offset, limit=None):
+        """
+        Requests chat messages after first 'offset' messages
+        (negative - last messages), not more than 'limit' of them
+        """
+
+        user_data = {'username': self.username, 'offset': offset}
+        if limit is not None:
+            user_data.update({'limit': limit})
+
+        if key == 'common':
+            self._sender.send_request(
+                action='common_chat', user_data=user_data
+            )
+        else:
+            user_data.update(
+                {'user_id': self.user_id, 'contact_id': self.contacts.get(key)}
+            )
+            self._sender.send_request(action='get_chat', user_data=user_data)
+
+    def show_stored_chat(self, key):
+        """
+        Shows last page of chat history from local store before server
+        answers, returns offset for request of newer messages
+        """
+
+        chat_id = self.store.chat_id(key)
+        last_seq = self.store.last_seq(chat_id) if chat_id else 0
+
+        if not last_seq:
+            # only last page of unknown chat is requested
+            return -settings.CHAT_PAGE_SIZE
+
+        self.open_chat_view(chat_id, key)
+        return last_seq
+
+    def open_chat_view(self, chat_id, key):
+        self.active_chat = chat_id
+        self.active_key = key
+        self.loading = False
+
+        # recipient of messages typed before server answers
+        private = key != 'common'
+        self.chats_data[chat_id] = {
+            'contact_user_id': self.contacts.get(key) if private else None,
+            'contact_username': key if private else None
+        }
+        self.messages_model.set_messages(
+            self.store.messages(chat_id, limit=settings.CHAT_PAGE_SIZE)
+        )
+        self.chat_view.scrollToBottom()
+
+    def chat_scrolled(self, value):
+        if value == self.chat_view.verticalScrollBar().minimum():
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        """
+        Shows previous page of active chat from local store or
+        requests it from server if it is not stored
+        """
+
+        first_seq = self.messages_model.first_seq
+        if not self.active_chat or first_seq <= 1 or self.loading:
+            return
+
+        older = self.store.messages(
+            self.active_chat, before=first_seq,
+            limit=settings.CHAT_PAGE_SIZE
+        )
+        if older:
+            self.show_older_messages(older)
+            return
+
+        self.loading = True
+        self.request_chat(
+            self.active_key,
+            max(first_seq - 1 - settings.CHAT_PAGE_SIZE, 0),
+            min(first_seq - 1, settings.CHAT_PAGE_SIZE)
         )
 
+    def show_older_messages(self, messages):
+        # view stays at the same message
+        added = self.messages_model.prepend(messages)
+        self.chat_view.scrollTo(
+            self.messages_model.index(added), QListView.PositionAtTop
+        )
+
+    def show_new_messages(self, messages):
+        """Adds new messages of active chat, scrolls view to them"""
+
+        if len(messages) > settings.CHAT_PAGE_SIZE:
+            # only last page is shown, older are loaded by scrolling
+            self.open_chat_view(self.active_chat, self.active_key)
+            return
+
+        scroll_bar = self.chat_view.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+
+        self.messages_model.append(messages)
+        if at_bottom:
+            self.chat_view.scrollToBottom()
+
     def send_message_request(self):
         message = self.message_line_edit.text()
+        chat_data = self.chats_data.get(self.active_chat)
+
+        if chat_data is None:
+            # chat is not opened yet, recipient is unknown
+            return
 
         user_data = {
             'username': self.username,
             'message': message,
+            # server adds message with the same id only once, so
+            # message can be sent again after reconnection
+            'message_id': uuid.uuid4().hex,
             'chat_id': self.active_chat,
             'user_id': self.user_id,
-            'contact_user_id': self.chats_data.get(self.active_chat).get(
-                'contact_user_id'),
-            'contact_username': self.chats_data.get(self.active_chat).get(
-                'contact_username')
+            'contact_user_id': chat_data.get('contact_user_id'),
+            'contact_username': chat_data.get('contact_username')
         }
 
         self._sender.send_request(action='add_message', user_data=user_data)
         self.message_line_edit.clear()
 
-    def append_messages(self, messages):
-        if messages:
-            for message in messages:
-                self.chat_text_edit.append(
-                    '{0}: {1}'.format(message[0], message[1])
-                )
-
     def append_message(self, message):
-        self.chat_text_edit.append(
-                    '{0}: {1}'.format(message.get('sender'), message.get('text'))
+        self.show_new_messages(
+            [(message.get('seq'), message.get('sender'), message.get('text'))]
+        )
+
+    def save_message(self, data):
+        chat_id = data.get('chat_id')
+        self.store.add(
+            chat_id,
+            [(data.get('seq'), *data.get('message'))] if data.get('seq')
+            else []
+        )
+
+        if data.get('contact_username') != self.username:
+            return
+
+        # private message for this user
+        if chat_id == self.active_chat:
+            self.acknowledge(chat_id, data.get('seq'))
+        else:
+            self.unread[chat_id] = self.unread.get(chat_id, 0) + 1
+            self.chat_names[chat_id] = data.get('message')[0]
+            self.show_unread()
+
+    def show_deliveries(self, deliveries):
+        """
+        Stores missed private messages (pushed by server after login
+        and resume), shows unread counts and requests next batch
+        """
+
+        for message in deliveries.get('messages', []):
+            self.chat_names[message['chat_id']] = message['message'][0]
+            self.store.add(
+                message['chat_id'], [(message['seq'], *message['message'])]
+            )
+
+        self.unread = deliveries.get('unread', {})
+        self.unread.pop(self.active_chat, None)
+        for chat_id in self.acks:
+            self.unread.pop(chat_id, None)
+        self.show_unread()
+
+        if deliveries.get('more'):
+            self._sender.send_request(
+                action='deliveries',
+                user_data={
+                    'username': self.username,
+                    'after': deliveries.get('cursor')
+                }
+            )
+
+    def show_unread(self):
+        self.unread_label.setText(
+            '\n'.join(
+                '{}: {}'.format(self.chat_names.get(chat_id, 'chat'), count)
+                for chat_id, count in self.unread.items()
+            )
+        )
+
+    def acknowledge(self, chat_id, seq):
+        """
+        Remembers that private messages of chat were read, server is
+        informed about all of them after ACK_DELAY seconds
+        """
+
+        self.acks[chat_id] = max(seq or 0, self.acks.get(chat_id, 0))
+        if not self.ack_timer.isActive():
+            self.ack_timer.start()
+
+    def send_acks(self):
+        if self.acks:
+            self._sender.send_request(
+                action='deliveries',
+                user_data={'username': self.username, 'ack': self.acks}
+            )
+            self.acks = {}
+
+    def sync(self, data):
+        """
+        Stores messages missed by stored chats and requests next
+        page while server has more of them (after login and resume)
+        """
+
+        for chat_id, chat in data.get('chats', {}).items():
+            self.store.add(chat_id, chat['messages'])
+
+            if chat_id == self.active_chat:
+                self.show_new_messages(
+                    [tuple(message) for message in chat['messages']]
                 )
 
+        chats = self.store.chats()
+
+        if chats and (data.get('action') != 'sync' or data.get('more')):
+            self._sender.send_request(
+                action='sync',
+                user_data={'username': self.username, 'chats': chats}
+            )
+
     def add_contact(self):
         self.add_contact_window.show()
 
@@ -896,39 +1211,91 @@ class ChatWindow(CommonMixin, CenterMixin, QWidget):
         self.column_view.repaint()
 
     def activate_chat(self, data):
-        self.active_chat = data.get('chat_id')
+        chat_id = data.get('chat_id')
+        key = data.get('contact_username') or 'common'
+        offset = data.get('offset', 0)
+        messages = [
+            (offset + number, sender, text)
+            for number, (sender, text) in enumerate(
+                data.get('messages') or [], 1
+            )
+        ]
+
+        if data.get('total', 0) < offset:
+            # server has less messages than local store (database was
+            # cleared), stored history is dropped and requested again
+            self.store.clear(chat_id)
+            self.request_chat(key, -settings.CHAT_PAGE_SIZE)
+            return
+
+        self.store.save(key, chat_id, data.get('messages') or [], offset)
         self.messages_lenght = data.get('lenght')
-        self.chat_text_edit.clear()
 
         self.chats_data.update(
             {
-                self.active_chat: {
+                chat_id: {
                     'contact_user_id': data.get('contact_user_id'),
                     'contact_username': data.get('contact_username')
                 }
             }
         )
 
-        self.chat_text_edit.setDisabled(False)
+        self.chat_view.setDisabled(False)
         self.message_line_edit.setDisabled(False)
-        self.chat_text_edit.clear()
 
-        messages = data.get('messages')
+        if self.unread.pop(chat_id, None):
+            self.acknowledge(chat_id, data.get('total'))
+            self.show_unread()
 
-        if messages:
-            self.append_messages_to_textbox.emit(messages)
+        if chat_id != self.active_chat:
+            self.open_chat_view(chat_id, key)
 
-    def closeEvent(self, event):
-        self._sender.send_request(
-            action='logout', user_data={'username': self.username}
+        elif messages and messages[-1][0] < self.messages_model.first_seq:
+            # older page requested by scrolling up
+            self.loading = False
+            self.show_older_messages(messages)
+
+        else:
+            self.loading = False
+            self.show_new_messages(messages)
+
+    def expire_session(self):
+        """
+        Server does not know user after reconnection (token expired
+        or server restarted with other key), user logs in again and
+        not sent messages are sent after it
+        """
+
+        self.expired = True
+        self.close()
+        self.parent.status_bar.showMessage('Session expired, log in again')
+
+    def show_failed_message(self, response):
+        """Message was dropped, it is not added to chat"""
+
+        QMessageBox.warning(
+            self, 'Message was not sent',
+            'Server did not add message: {} ({})'.format(
+                response.get('info'), response.get('code')
+            )
         )
 
+    def closeEvent(self, event):
+        if not self.expired:
+            self._sender.send_request(
+                action='logout',
+                user_data={'username': self.username, 'token': self.token}
+            )
+        self.expired = False
+
         event.accept()
         self.parent.show()
 
-        self.chat_text_edit.clear()
-        self.chat_text_edit.setDisabled(True)
+        self.messages_model.set_messages([])
+        self.chat_view.setDisabled(True)
         self.message_line_edit.setDisabled(True)
+        self.active_chat = None
+        self.store.close()
 
 
 class ClientGui(CenterMixin, QWidget):
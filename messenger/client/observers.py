@@ -27,36 +27,66 @@ class Notifier(ABC):
 
 
 class BaseNotifier(Notifier):
+    """
+    Keeps listeners indexed by event and action:
+    {event: {action: [listener, ...]}}, listeners of all actions are
+    kept with None action. Notification with 'action' (responses)
+    calls only listeners of this action and listeners of all actions,
+    listeners with 'codes' are called only for these response codes.
+    """
 
     _listeners: Dict = {}
 
     def add_listener(self, event: str, listener: 'Listener') -> None:
         """Adds listener to notifier"""
 
-        if event in self._listeners:
-            self._listeners[event].append(listener)
-        else:
-            self._listeners[event] = [listener]
+        actions = self._listeners.setdefault(event, {})
+        for action in listener.actions or (None,):
+            actions.setdefault(action, []).append(listener)
 
     def remove_listener(self, event: str, listener: 'Listener') -> None:
         """Remove listener from notifier"""
 
-        if len(self._listeners[event]) > 1:
-            self._listeners[event].remove(listener)
-        else:
-            self._listeners.pop(event)
+        actions = self._listeners.get(event, {})
+        for action in listener.actions or (None,):
+            listeners = actions.get(action, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                actions.pop(action, None)
+
+        if not actions:
+            self._listeners.pop(event, None)
 
     def notify(self, event: str, *args, **kwargs) -> None:
-        """Notify every listener about changed state"""
+        """Notify listeners of event (and of action) about changed state"""
+
+        actions = self._listeners.get(event)
+        if not actions:
+            return
+
+        action = kwargs.get('action')
+        code = kwargs.get('code')
 
-        for listener in self._listeners[event]:
-            listener.refresh(self, *args, **kwargs)
+        listeners = actions.get(None, [])
+        if action is not None:
+            listeners = actions.get(action, []) + listeners
+
+        for listener in listeners:
+            if listener.codes is None or code in listener.codes:
+                listener.refresh(self, *args, **kwargs)
 
 
 class Listener(ABC):
-    """Listener interface"""
+    """
+    Listener interface.
+    Listener is notified only about responses with 'actions' and
+    'codes' if they are set (None - any action or code).
+    """
 
     event: str
+    actions: tuple = None
+    codes: tuple = None
 
     def __init__(self, obj, notifier):
         self.employer = obj
@@ -104,101 +134,136 @@ class StatusGroupListener(Listener):
 class LoginListener(Listener):
 
     event = 'response'
+    actions = ('login',)
+    codes = (200,)
 
     def refresh(self, *args, **kwargs) -> None:
-
-        if kwargs.get('action') == 'login' and kwargs.get('code') == 200:
-            self.employer.parent.chat.emit(kwargs)
-            self.employer.close_window.emit()
+        self.employer.parent.chat.emit(kwargs)
+        self.employer.close_window.emit()
 
 
-class ContactListener(Listener):
+class SessionExpiredListener(Listener):
+    """Session was not resumed after reconnection"""
 
     event = 'response'
+    actions = ('resume',)
+    codes = (205,)
 
     def refresh(self, *args, **kwargs) -> None:
+        self.employer.session_expired.emit()
 
-        if kwargs.get('code') == 200:
 
-            if kwargs.get('action') == 'add_contact':
-                self.employer.update_model_add.emit(kwargs.get('new_contact'))
+class MessageFailedListener(Listener):
+    """Message was rejected by server or retries were exhausted"""
 
-            elif kwargs.get('action') == 'delete_contact':
-                self.employer.update_model_delete.emit(kwargs.get('contact'))
+    event = 'failed'
+    actions = ('add_message',)
 
+    def refresh(self, *args, **kwargs) -> None:
+        self.employer.message_failed.emit(kwargs)
 
-class ChatListener(Listener):
+
+class ContactListener(Listener):
 
     event = 'response'
+    actions = ('add_contact', 'delete_contact')
+    codes = (200,)
 
     def refresh(self, *args, **kwargs) -> None:
 
-        if kwargs.get('code') == 200:
+        if kwargs.get('action') == 'add_contact':
+            self.employer.update_model_add.emit(kwargs.get('new_contact'))
+        else:
+            self.employer.update_model_delete.emit(kwargs.get('contact'))
 
-            if kwargs.get('action') in ('get_chat', 'common_chat'):
-                self.employer.open_chat.emit(kwargs)
+
+class ChatListener(Listener):
+
+    event = 'response'
+    actions = ('get_chat', 'common_chat')
+    codes = (200,)
+
+    def refresh(self, *args, **kwargs) -> None:
+        self.employer.open_chat.emit(kwargs)
 
 
 class NewMessageListener(Listener):
 
     event = 'response'
+    actions = ('add_message',)
+    codes = (200,)
 
     def refresh(self, *args, **kwargs) -> None:
+        self.employer.store_message.emit(kwargs)
+        active_chat = getattr(self.employer, 'active_chat', None)
+
+        if active_chat and active_chat == kwargs.get('chat_id'):
 
-        if kwargs.get('code') == 200:
+            self.employer.append_message_to_textbox.emit(
+                {
+                    'seq': kwargs.get('seq'),
+                    'sender': kwargs.get('message')[0],
+                    'text': kwargs.get('message')[1]
+                }
+            )
 
-            if kwargs.get('action') == 'add_message':
-                active_chat = getattr(self.employer, 'active_chat', None)
 
-                if active_chat and active_chat == kwargs.get('chat_id'):
+class SyncListener(Listener):
+    """Starts chats synchronization after session resuming"""
 
-                    self.employer.append_message_to_textbox.emit(
-                        {
-                            'sender': kwargs.get('message')[0],
-                            'text': kwargs.get('message')[1]
-                        }
-                    )
+    event = 'response'
+    actions = ('resume', 'sync')
+    codes = (200,)
 
+    def refresh(self, *args, **kwargs) -> None:
+        self.employer.sync_chats.emit(kwargs)
 
-class ProfileListener(Listener):
+
+class DeliveryListener(Listener):
+    """Shows messages missed while client was offline"""
 
     event = 'response'
+    actions = ('deliveries',)
+    codes = (200,)
 
     def refresh(self, *args, **kwargs) -> None:
+        deliveries = kwargs.get('deliveries')
 
-        if kwargs.get('code') == 200:
+        # acknowledgement responses have no batch
+        if deliveries:
+            self.employer.receive_deliveries.emit(deliveries)
 
-            if kwargs.get('action') == 'profile':
 
-                self.employer.open_profile.emit(kwargs.get('user_data'))
+class ProfileListener(Listener):
+
+    event = 'response'
+    actions = ('profile',)
+    codes = (200,)
+
+    def refresh(self, *args, **kwargs) -> None:
+        self.employer.open_profile.emit(kwargs.get('user_data'))
 
 
 class AvatarListener(Listener):
 
     event = 'response'
+    actions = ('login', 'update_profile')
+    codes = (200,)
 
     def refresh(self, *args, **kwargs) -> None:
-        if kwargs.get('code') == 200:
-
-            if kwargs.get('action') in ('login', 'update_profile'):
-                file_name = kwargs.get('user_data').get('file_name')
+        file_name = kwargs.get('user_data').get('file_name')
 
-                if file_name:
-                    self.employer.set_avatar_signal.emit(file_name)
-                else:
-                    self.employer.avatar_label.clear()
+        if file_name:
+            self.employer.set_avatar_signal.emit(file_name)
+        else:
+            self.employer.avatar_label.clear()
 
 
 class SearchMessageListener(Listener):
 
     event = 'response'
+    actions = ('search_in_chat',)
+    codes = (200,)
 
     def refresh(self, *args, **kwargs) -> None:
-
-        if kwargs.get('code') == 200:
-
-            if kwargs.get('action') == 'search_in_chat':
-
-                self.employer.set_searched_messages.emit(
-                    kwargs.get('messages')
-                )
+        self.employer.set_searched_messages.emit(kwargs.get('messages'))
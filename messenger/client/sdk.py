@@ -0,0 +1,317 @@
+"""
+Headless asyncio client for messenger server, for bots, bridges and
+load tests. It does not depend on PyQt and client settings, one event
+loop can hold thousands of AsyncClient sessions:
+
+    client = AsyncClient('localhost', 40000)
+    await client.connect()
+    await client.login('bob', 'password')
+    await client.add_message('hello', chat_id=common_chat_id)
+
+    async for message in client:
+        print(message['message'])
+"""
+import json
+import time
+import uuid
+import asyncio
+import itertools
+from typing import Dict
+
+
+# every request and response is one json document followed by newline
+FRAME_END = b'\n'
+
+
+class ClientError(Exception):
+    """Server answered with error code or connection is lost"""
+
+    def __init__(self, info: str, response: Dict = None) -> None:
+        super().__init__(info)
+        self.response = response or {}
+
+    @property
+    def code(self):
+        return self.response.get('code')
+
+
+class AsyncClient:
+    """
+    Asyncio client, every server action is a coroutine returning
+    response data. Every request has id echoed by server in response
+    'request_id', so many requests can wait for responses at once.
+    Frames without request id are pushed by server (new messages of
+    other users), they are got by iterating over client.
+
+    At most 'max_pushes' pushes (0 - no limit) wait for iteration, the
+    oldest one is dropped (and counted in 'dropped_pushes') when queue
+    is full. Pushes must not slow down reading of frames, otherwise
+    client not iterating over pushes would never get responses.
+    """
+
+    def __init__(
+            self, host: str = 'localhost', port: int = 40000,
+            encoding: str = 'utf-8', timeout: float = 10,
+            buffer_size: int = 65536, max_pushes: int = 1000
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.encoding = encoding
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        # {request id: future of response}
+        self.pending: Dict = {}
+        self.counter = itertools.count(1)
+        self.pushes = asyncio.Queue(max_pushes)
+        self.dropped_pushes = 0
+        self.username = None
+        self.user_id = None
+        self.token = None
+        self.contacts = {}
+        self.reader_task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Dict:
+        message = await self.pushes.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, limit=self.buffer_size
+        )
+        self.reader_task = asyncio.ensure_future(self.read_frames())
+
+    async def close(self) -> None:
+        if self.reader_task:
+            self.reader_task.cancel()
+            self.writer.close()
+            self.reader_task = None
+            self.fail(ClientError('Connection closed'))
+
+    def fail(self, error: Exception) -> None:
+        """Fails all waiting requests and stops pushes iteration"""
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.push(None)
+
+    async def read_frames(self) -> None:
+        try:
+            while True:
+                frame = await self.reader.readline()
+                if not frame:
+                    break
+                if frame.strip():
+                    self.handle_frame(frame)
+        except (ConnectionError, ValueError):
+            pass
+        self.fail(ClientError('Connection lost'))
+
+    def handle_frame(self, frame: bytes) -> None:
+        response = json.loads(json.loads(frame.decode(self.encoding)))
+        action = response.get('action')
+
+        if action == 'ping':
+            self.write('pong')
+            return
+
+        if action is None:
+            # connections limit reached, server closes connection
+            self.fail(ClientError(response.get('info'), response))
+            return
+
+        future = self.pending.pop(response.get('request_id'), None)
+
+        if future is None:
+            self.push(response)
+        elif not future.done():
+            future.set_result(response)
+
+    def push(self, message) -> None:
+        """Queues pushed message, the oldest one is dropped if queue is full"""
+
+        if self.pushes.full():
+            self.pushes.get_nowait()
+            self.dropped_pushes += 1
+        self.pushes.put_nowait(message)
+
+    def write(self, action: str, request_id=None, **data) -> None:
+        request = {
+            'action': action,
+            'id': request_id,
+            'time': time.time(),
+            'timeout': self.timeout,
+            'data': data,
+        }
+        self.writer.write(
+            json.dumps(request).encode(self.encoding) + FRAME_END
+        )
+
+    async def request(self, action: str, **data) -> Dict:
+        """
+        Sends request and returns response data.
+        Raises ClientError if response code is not 200.
+        """
+
+        if not self.reader_task:
+            raise ClientError('Client is not connected')
+
+        request_id = next(self.counter)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        self.write(action, request_id, **data)
+
+        try:
+            await self.writer.drain()
+            response = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise ClientError('Response timeout')
+        finally:
+            self.pending.pop(request_id, None)
+
+        if response.get('code') != 200:
+            raise ClientError(response.get('info'), response)
+        return response
+
+    def user_data(self, **data) -> Dict:
+        data.update({'username': self.username, 'user_id': self.user_id})
+        return data
+
+    def set_session(self, response: Dict) -> Dict:
+        user_data = response['user_data']
+        self.username = user_data['username']
+        self.user_id = user_data.get('user_id')
+        self.token = user_data.get('token')
+        self.contacts = user_data.get('contacts', self.contacts)
+        return response
+
+    # [auth] actions
+
+    async def register(self, username: str, password: str) -> Dict:
+        return await self.request(
+            'register', username=username, password=password,
+            repeat_password=password
+        )
+
+    async def login(self, username: str, password: str) -> Dict:
+        return self.set_session(
+            await self.request(
+                'login', username=username, password=password
+            )
+        )
+
+    async def resume(self, token: str = None) -> Dict:
+        return self.set_session(
+            await self.request('resume', token=token or self.token)
+        )
+
+    async def logout(self) -> None:
+        """Server does not answer logout"""
+
+        self.write('logout', username=self.username, token=self.token)
+        await self.writer.drain()
+        self.username = self.user_id = self.token = None
+
+    # [chat] actions
+
+    async def common_chat(self) -> Dict:
+        return await self.request('common_chat', username=self.username)
+
+    async def get_chat(self, contact: str) -> Dict:
+        return await self.request(
+            'get_chat',
+            **self.user_data(contact_id=self.contacts[contact])
+        )
+
+    async def add_message(
+            self, message: str, chat_id: str, contact: str = None,
+            message_id: str = None
+    ) -> Dict:
+        """
+        Sends message to chat, contact - username for private chat.
+        Message is added once for the same message_id, so it is safe
+        to retry (response has 'duplicate' flag then).
+        """
+
+        return await self.request(
+            'add_message',
+            **self.user_data(
+                message=message,
+                message_id=message_id or uuid.uuid4().hex,
+                chat_id=chat_id,
+                contact_username=contact,
+                contact_user_id=self.contacts.get(contact),
+            )
+        )
+
+    async def search_in_chat(self, word: str, chat_id: str) -> Dict:
+        return await self.request(
+            'search_in_chat', **self.user_data(word=word, chat_id=chat_id)
+        )
+
+    async def sync(self, chats: Dict) -> Dict:
+        """
+        Returns messages added after known sequence numbers
+        {chat_id: seq}, repeat while response 'more' is true
+        """
+
+        return await self.request(
+            'sync', username=self.username, chats=chats
+        )
+
+    async def deliveries(self, ack: Dict = None, after: str = None) -> Dict:
+        """
+        Acknowledges read private messages {chat_id: seq}, without
+        'ack' or with 'after' (cursor of previous batch) returns next
+        batch of not acknowledged ones (first batch is pushed by server
+        after login and resume)
+        """
+
+        data = {'ack': ack} if ack else {}
+        if after or not ack:
+            data['after'] = after
+
+        return await self.request(
+            'deliveries', username=self.username, **data
+        )
+
+    async def add_contact(self, contact: str) -> Dict:
+        response = await self.request(
+            'add_contact', username=self.username, contact=contact
+        )
+        self.contacts.update(response.get('new_contact', {}))
+        return response
+
+    async def delete_contact(self, contact: str) -> Dict:
+        response = await self.request(
+            'delete_contact', username=self.username, contact=contact,
+            contact_id=self.contacts.get(contact)
+        )
+        self.contacts.pop(contact, None)
+        return response
+
+    async def profile(self) -> Dict:
+        return await self.request('profile', username=self.username)
+
+    async def update_profile(self, **profile) -> Dict:
+        return await self.request(
+            'update_profile', username=self.username, **profile
+        )
+
+    # [admin] actions
+
+    async def stats(self, admin_token: str) -> Dict:
+        return await self.request('stats', admin_token=admin_token)
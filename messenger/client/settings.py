@@ -7,6 +7,30 @@ ENCODING_NAME = 'utf-8'
 BUFFER_SIZE = 65536
 HOST = 'localhost'
 PORT = 40000
+# seconds without any data from server (server pings idle connections
+# every 30 seconds) after which connection is considered lost
+HEARTBEAT_TIMEOUT = 75
+# seconds after which server stops processing request
+REQUEST_TIMEOUT = 10
+# lost connection is opened again after random delay growing
+# from RECONNECT_DELAY_MIN to RECONNECT_DELAY_MAX seconds
+RECONNECT = True
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+# message answered with 429, 503 or 504 is sent again after delay
+# growing from RETRY_DELAY_MIN to RETRY_DELAY_MAX seconds, message
+# is dropped after RETRY_ATTEMPTS attempts
+RETRY_DELAY_MIN = 0.5
+RETRY_DELAY_MAX = 10
+RETRY_ATTEMPTS = 5
+# directory of local message stores (one sqlite file per account)
+STORE_DIR = os.path.join(BASE_DIR, 'store')
+# number of chat messages loaded at once (opening chat and scrolling
+# up to older messages)
+CHAT_PAGE_SIZE = 100
+# read private messages are acknowledged at most once per this
+# number of seconds (all chats in one request)
+ACK_DELAY = 1
 
 
 try:
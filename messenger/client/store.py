@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+
+class MessageStore:
+    """
+    Local SQLite copy of chat histories of one account, so opened chat
+    is shown at once and only messages newer than stored ones are
+    requested from server. Message seq is its position in chat
+    starting from 1, chat key is contact username or 'common'.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS chats ('
+        'key TEXT PRIMARY KEY, chat_id TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS messages ('
+        'chat_id TEXT NOT NULL, seq INTEGER NOT NULL, '
+        'sender TEXT, text TEXT, PRIMARY KEY (chat_id, seq))',
+    )
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # store is used by gui and client threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+
+    @classmethod
+    def for_account(
+            cls, directory: str, host: str, port: int, username: str
+    ) -> 'MessageStore':
+        return cls(
+            os.path.join(
+                directory, '{}_{}_{}.sqlite3'.format(host, port, username)
+            )
+        )
+
+    def chat_id(self, key: str) -> str:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT chat_id FROM chats WHERE key = ?', (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def last_seq(self, chat_id: str) -> int:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT MAX(seq) FROM messages WHERE chat_id = ?',
+                (chat_id,)
+            ).fetchone()
+        return row[0] or 0
+
+    def chats(self) -> Dict:
+        """Returns last stored seq of every chat {chat_id: seq}"""
+
+        with self.lock:
+            return dict(
+                self.db.execute(
+                    'SELECT chats.chat_id, COALESCE(MAX(seq), 0) '
+                    'FROM chats LEFT JOIN messages '
+                    'ON messages.chat_id = chats.chat_id '
+                    'GROUP BY chats.chat_id'
+                ).fetchall()
+            )
+
+    def first_seq(self, chat_id: str) -> int:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT MIN(seq) FROM messages WHERE chat_id = ?',
+                (chat_id,)
+            ).fetchone()
+        return row[0] or 0
+
+    def messages(
+            self, chat_id: str, before: int = None, limit: int = -1
+    ) -> List[Tuple]:
+        """
+        Returns (seq, sender, text) of last 'limit' stored chat
+        messages (all by default) with seq less than 'before'
+        """
+
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT seq, sender, text FROM messages '
+                'WHERE chat_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+                (chat_id, before or 2 ** 62, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def save(
+            self, key: str, chat_id: str, messages: List, offset: int
+    ) -> None:
+        """Stores messages received after first 'offset' messages"""
+
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO chats (key, chat_id) VALUES (?, ?)',
+                (key, chat_id)
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO messages (chat_id, seq, sender, text) '
+                'VALUES (?, ?, ?, ?)',
+                [
+                    (chat_id, offset + number, sender, text)
+                    for number, (sender, text) in enumerate(messages, 1)
+                ]
+            )
+
+    def add(self, chat_id: str, messages: List) -> None:
+        """
+        Stores messages (seq, sender, text) of known chat which follow
+        stored ones without gaps (so last seq shows what is missing)
+        """
+
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT MAX(seq) FROM messages WHERE chat_id = ?',
+                (chat_id,)
+            ).fetchone()
+            last_seq = row[0] or 0
+            rows = []
+
+            for seq, sender, text in sorted(messages):
+                if seq <= last_seq:
+                    continue
+                if seq != last_seq + 1:
+                    break
+                rows.append((chat_id, seq, sender, text))
+                last_seq = seq
+
+            self.db.executemany(
+                'INSERT INTO messages (chat_id, seq, sender, text) '
+                'VALUES (?, ?, ?, ?)', rows
+            )
+
+    def clear(self, chat_id: str) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM messages WHERE chat_id = ?', (chat_id,)
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -9,12 +9,27 @@ from PyQt5.QtWidgets import QApplication
 
 import settings
 from core import Server
+from supervisor import Supervisor
 from gui import ServerGui
+from tracing import tracer
+from logs import (
+    start_logging,
+    TextFormatter,
+    JsonFormatter
+)
 
 
 faulthandler.enable()
 
 
+def parse_peer(value: str):
+    """Parses 'name=host:port' into (name, (host, port))"""
+
+    name, address = value.split('=', 1)
+    host, port = address.rsplit(':', 1)
+    return name, (host, int(port))
+
+
 # adding arguments to command line and parsing them
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -28,6 +43,31 @@ parser.add_argument(
 parser.add_argument(
     '-g', '--gui', action='store_const', const=True, default=False
 )
+parser.add_argument(
+    '-w', '--workers', type=int,
+    help='Number of worker processes sharing port (without GUI only)'
+)
+parser.add_argument(
+    '-m', '--metrics-port', type=int,
+    help='TCP port of metrics endpoint'
+)
+parser.add_argument(
+    '-n', '--node', type=str,
+    help='Name of this node in cluster'
+)
+parser.add_argument(
+    '-c', '--cluster-port', type=int,
+    help='TCP port for links from other cluster nodes'
+)
+parser.add_argument(
+    '--peer', type=str, action='append', default=[],
+    metavar='NAME=HOST:PORT',
+    help='Other cluster node (can be used several times)'
+)
+parser.add_argument(
+    '-t', '--trace', action='store_const', const=True, default=False,
+    help='Record request processing spans to trace file'
+)
 args = parser.parse_args()
 
 
@@ -37,13 +77,16 @@ if 'log' not in os.listdir(settings.BASE_DIR):
         ''.join([settings.BASE_DIR, '/log/'])
     )
 
-formatter = logging.Formatter(
-    fmt=r'%(asctime)s - %(levelname)s - %(message)s',
-    datefmt=r'%Y-%m-%d - %H:%M:%S'
-)
+if settings.LOG_FORMAT == 'json':
+    formatter = JsonFormatter(datefmt=r'%Y-%m-%d - %H:%M:%S')
+else:
+    formatter = TextFormatter(
+        fmt=r'%(asctime)s - %(levelname)s - %(message)s',
+        datefmt=r'%Y-%m-%d - %H:%M:%S'
+    )
 
 handler = logging.handlers.TimedRotatingFileHandler(
-    filename=''.join([settings.BASE_DIR, '/log/server_log.log']),
+    filename=settings.LOG_FILE.format(worker=''),
     when='D',
     interval=1,
 )
@@ -53,7 +96,11 @@ handler.setFormatter(formatter)
 
 logger = logging.getLogger('server_logger')
 logger.setLevel(logging.DEBUG)
-logger.addHandler(handler)
+start_logging(logger, handler)
+
+
+if args.trace:
+    tracer.enabled = True
 
 
 try:
@@ -69,6 +116,29 @@ try:
                 'port': args.port
             }
             server.settings.update(cmd_settings)
-        server.run()
+
+        node_settings = {
+            'node_name': args.node,
+            'cluster_port': args.cluster_port,
+            'metrics_port': args.metrics_port,
+        }
+        if args.peer:
+            node_settings['cluster_peers'] = dict(
+                parse_peer(peer) for peer in args.peer
+            )
+        server.settings.update(
+            {
+                attr: value for attr, value in node_settings.items()
+                if value is not None
+            }
+        )
+
+        workers = args.workers or settings.WORKERS
+        if workers > 1 and server.settings.cluster_peers:
+            parser.error('cluster nodes run without worker processes')
+        elif workers > 1:
+            Supervisor(Server, workers, server.bus_path).run()
+        else:
+            server.run()
 except KeyboardInterrupt:
     logger.info('Server closed')
@@ -0,0 +1,42 @@
+from hmac import compare_digest
+
+import settings
+from core import (
+    RequestHandler,
+    Response,
+    Response_403,
+)
+from metrics import metrics
+
+
+class AdminBase(RequestHandler):
+    """Base class for [admin] app controllers"""
+
+    def validate_request(self):
+        """
+        Checks if request contains admin token from settings.
+        Empty 'ADMIN_TOKEN' setting disables [admin] actions.
+        """
+        token = self.request.data.get('admin_token') or ''
+
+        if settings.ADMIN_TOKEN:
+            return compare_digest(token, settings.ADMIN_TOKEN)
+        return False
+
+
+class Stats(AdminBase):
+    """Returns snapshot of server metrics"""
+
+    def process(self):
+
+        if self.validate_request():
+            return Response(
+                self.request,
+                data={
+                    'code': 200,
+                    'info': 'Server metrics snapshot',
+                    'stats': metrics.snapshot()
+                }
+            )
+        else:
+            return Response_403(self.request)
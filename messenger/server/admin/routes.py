@@ -0,0 +1,7 @@
+from .controllers import (
+    Stats,
+)
+
+routes = [
+    {'action': 'stats', 'controller': Stats},
+]
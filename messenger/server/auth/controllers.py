@@ -6,6 +6,7 @@ from core import (
     Response_400,
 )
 from mongo import User
+from sessions import sessions
 
 
 logger = logging.getLogger('server_logger')
@@ -66,20 +67,18 @@ class Login(AuthBase):
     def process(self):
         if self.validate_request(self.request.data):
             username = self.request.data.get('username')
-            user = self.model.get_user(username)
+            user, contacts = self.model.get_user_with_contacts(username)
 
             if user:
                 password = self.request.data.get('password')
 
                 if user.check_password(password):
-                    user.set_auth_state(True)
-
                     user_data = {
                         'username': user.username,
                         'user_id': user.id,
-                        'contacts': user.get_contacts(),
+                        'contacts': contacts,
+                        'token': sessions.issue(user.username, user.id),
                     }
-                    
 
                     if hasattr(user, 'avatar'):
                         if bool(user.avatar):
@@ -107,6 +106,35 @@ class Login(AuthBase):
             return Response_400(self.request)
 
 
+class Resume(RequestHandler):
+    """
+    Class for resuming session with token given by login,
+    token is checked without database and password hashing
+    """
+
+    def process(self):
+        payload = sessions.verify(self.request.data.get('token'))
+
+        if not payload:
+            return Response(
+                self.request,
+                {'code': 205, 'info': 'Session expired or revoked'}
+            )
+
+        return Response(
+            self.request,
+            data={
+                'code': 200,
+                'info': 'Session resumed',
+                'user_data': {
+                    'username': payload['username'],
+                    'user_id': payload['user_id'],
+                    'token': self.request.data.get('token'),
+                }
+            }
+        )
+
+
 class Logout(AuthBase):
 
     def validate_request(self, data):
@@ -120,7 +148,7 @@ class Logout(AuthBase):
             user = self.model.get_user(username)
 
             if user:
-                user.set_auth_state(False)
+                sessions.revoke(self.request.data.get('token'))
 
                 return Response(
                     self.request, {
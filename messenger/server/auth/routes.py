@@ -1,11 +1,25 @@
 from .controllers import (
     Register,
     Login,
+    Resume,
     Logout
 )
 
 routes = [
-    {'action': 'register', 'controller': Register},
-    {'action': 'login', 'controller': Login},
+    {
+        'action': 'register',
+        'controller': Register,
+        'rate_limit': {'rate': 0.1, 'burst': 3}
+    },
+    {
+        'action': 'login',
+        'controller': Login,
+        'rate_limit': {'rate': 0.2, 'burst': 5}
+    },
+    {
+        'action': 'resume',
+        'controller': Resume,
+        'rate_limit': {'rate': 1, 'burst': 10}
+    },
     {'action': 'logout', 'controller': Logout}
 ]
@@ -0,0 +1,217 @@
+"""
+Connection churn soak run without MongoDB. Server is started in this
+process with stub routes, every round opens connections, logs in new
+users, sends private messages, closes half of connections with logout
+and drops the other half. After every round registry, presence and
+memory traced by tracemalloc must return to the same level.
+
+python server/bench/churn.py -r 50 -c 200
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import (  # noqa: E402
+    Server,
+    Router,
+    RequestHandler,
+    Response,
+)
+from tracing import tracer  # noqa: E402
+
+
+class Login(RequestHandler):
+
+    def process(self):
+        return Response(
+            self.request,
+            data={
+                'code': 200,
+                'user_data': {'username': self.request.data.get('username')}
+            }
+        )
+
+
+class AddMessage(RequestHandler):
+
+    def process(self):
+        return Response(
+            self.request,
+            data={
+                'code': 200,
+                'chat_type': 'single',
+                'contact_username': self.request.data.get('contact_username'),
+                'message': [
+                    self.request.data.get('username'),
+                    self.request.data.get('message')
+                ]
+            }
+        )
+
+
+class Logout(RequestHandler):
+
+    def process(self):
+        return Response(
+            self.request,
+            data={'code': 200, 'username': self.request.data.get('username')}
+        )
+
+
+routes = {
+    'login': {'action': 'login', 'controller': Login},
+    'add_message': {
+        'action': 'add_message',
+        'controller': AddMessage,
+        'rate_limit': {'rate': 100, 'burst': 100}
+    },
+    'logout': {'action': 'logout', 'controller': Logout},
+}
+
+
+def frame(action: str, request_id: int, **data) -> bytes:
+    return json.dumps(
+        {'action': action, 'id': request_id, 'time': time.time(), 'data': data}
+    ).encode() + b'\n'
+
+
+async def wait_response(reader, request_id: int) -> None:
+    """Reads frames until response to request, pushes are skipped"""
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        if json.loads(json.loads(line)).get('request_id') == request_id:
+            return
+
+
+async def session(port: int, username: str, users, messages: int, logout):
+    reader, writer = await asyncio.open_connection('localhost', port)
+
+    writer.write(frame('login', 0, username=username))
+    await wait_response(reader, 0)
+
+    for number in range(1, messages + 1):
+        writer.write(
+            frame(
+                'add_message', number, username=username,
+                contact_username=random.choice(users), message='churn'
+            )
+        )
+        await wait_response(reader, number)
+
+    if logout:
+        # logout is not answered, server unbinds user and reads eof
+        writer.write(frame('logout', -1, username=username))
+        await writer.drain()
+        writer.close()
+    else:
+        # connection lost without logout
+        writer.transport.abort()
+
+
+async def churn_round(port: int, number: int, args) -> None:
+    users = [
+        'churn-{}-{}'.format(number, index) for index in range(args.clients)
+    ]
+    await asyncio.gather(
+        *[
+            session(port, username, users, args.messages, index % 2 == 0)
+            for index, username in enumerate(users)
+        ]
+    )
+
+
+def measure(server, timeout: float = 5):
+    """Waits until server released connections, returns counters"""
+
+    end = time.monotonic() + timeout
+    while len(server.connections) and time.monotonic() < end:
+        time.sleep(0.05)
+
+    # user rate limit buckets are pruned by reaper every few seconds,
+    # clients are gone, so it is done at once
+    server.limiter.prune()
+    gc.collect()
+    return (
+        len(server.connections),
+        len(server.connections.presence),
+        tracemalloc.get_traced_memory()[0]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=40900)
+    parser.add_argument('-r', '--rounds', type=int, default=20)
+    parser.add_argument('-c', '--clients', type=int, default=100)
+    parser.add_argument('-m', '--messages', type=int, default=5)
+    parser.add_argument(
+        '-w', '--warmup', type=int, default=3,
+        help='Rounds before memory baseline is taken'
+    )
+    parser.add_argument(
+        '--max-growth', type=int, default=512,
+        help='KiB of memory growth after warmup treated as leak'
+    )
+    args = parser.parse_args()
+
+    router = Router()
+    router.table = routes
+    router.pushes = []
+    # bounded trace buffer would look like growing memory
+    tracer.enabled = False
+
+    tracemalloc.start()
+
+    server = Server()
+    server.settings.update(
+        {
+            'port': args.port,
+            'metrics_port': None,
+            'cluster_peers': {},
+            'connections': args.clients * 2,
+        }
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while server.state != 'Connected':
+        time.sleep(0.05)
+
+    baseline = None
+    failed = False
+
+    for number in range(args.rounds):
+        asyncio.run(churn_round(args.port, number, args))
+        connections, online, memory = measure(server)
+
+        if number + 1 == args.warmup:
+            baseline = memory
+        growth = memory - baseline if baseline is not None else 0
+
+        print(
+            'round {:>4}  connections {:>5}  online {:>5}  '
+            'memory {:>8.1f} KiB  growth {:>7.1f} KiB'.format(
+                number, connections, online, memory / 1024, growth / 1024
+            )
+        )
+        failed = failed or connections or online
+
+    if baseline is not None and growth > args.max_growth * 1024:
+        failed = True
+
+    print('FAILED' if failed else 'OK')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
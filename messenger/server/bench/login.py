@@ -0,0 +1,93 @@
+"""
+Times login against MongoDB configured in settings (credentials.json):
+User.get_user_with_contacts alone and whole Login controller (password
+check and session token included). MongoDB calls of one login are
+counted too, login must take one round trip.
+
+python server/bench/login.py -u test -P test -n 200
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import Request  # noqa: E402
+from mongo import User  # noqa: E402
+from tracing import tracer  # noqa: E402
+from auth.controllers import Login  # noqa: E402
+
+
+def timed(function, number: int):
+    """Returns durations (milliseconds) of 'number' calls of function"""
+
+    durations = []
+    for _ in range(number):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def report(name: str, durations) -> None:
+    durations = sorted(durations)
+    print(
+        '{:<24} min {:>7.2f}  median {:>7.2f}  p95 {:>7.2f}  '
+        'max {:>7.2f} ms'.format(
+            name,
+            durations[0],
+            statistics.median(durations),
+            durations[int(len(durations) * 0.95) - 1],
+            durations[-1]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--username', type=str, required=True)
+    parser.add_argument('-P', '--password', type=str, required=True)
+    parser.add_argument('-n', '--number', type=int, default=100)
+    parser.add_argument(
+        '-w', '--warmup', type=int, default=5,
+        help='Not timed logins (connection pool, caches)'
+    )
+    args = parser.parse_args()
+
+    def login():
+        response = Login(
+            Request(
+                action='login',
+                data={'username': args.username, 'password': args.password}
+            )
+        ).process()
+
+        if response.data.get('code') != 200:
+            sys.exit('Login failed: {}'.format(response.data.get('info')))
+
+    def lookup():
+        User.get_user_with_contacts(args.username)
+
+    # login is checked and connections are opened before timing
+    for _ in range(args.warmup):
+        login()
+
+    tracer.enabled = True
+    tracer.events.clear()
+    login()
+    calls = [
+        event['name'] for event in tracer.events if event['cat'] == 'mongo'
+    ]
+    tracer.enabled = False
+    print('MongoDB calls of one login: {} ({})'.format(
+        len(calls), ', '.join(calls)
+    ))
+
+    report('get_user_with_contacts', timed(lookup, args.number))
+    report('Login.process', timed(login, args.number))
+
+
+if __name__ == '__main__':
+    main()
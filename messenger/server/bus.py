@@ -0,0 +1,221 @@
+import os
+import json
+import errno
+import asyncio
+from logging import getLogger
+from typing import Dict
+
+import settings
+
+
+logger = getLogger('server_logger')
+
+
+def encode_message(action: str, **data) -> bytes:
+    """Bus message is the same newline terminated json as requests"""
+
+    return json.dumps({'action': action, 'data': data}).encode(
+        settings.ENCODING_NAME
+    ) + b'\n'
+
+
+class BusHub:
+    """
+    Inter-process pub/sub hub running in supervisor process.
+    Workers connect to it with unix socket, hub relays their messages:
+    'presence', 'broadcast' and 'revoke' (session token revoked by
+    logout) go to all other workers, 'deliver' goes only to workers
+    where recipient is online.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.workers: Dict = {}
+        self.presence: Dict = {}
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            await self.remove_stale()
+
+        self.endpoint = await asyncio.start_unix_server(
+            self.handle_worker, path=self.path, limit=settings.BUFFER_SIZE
+        )
+
+    async def remove_stale(self) -> None:
+        """
+        Removes socket file left by killed supervisor, socket of
+        running supervisor (the same port is used) is not touched
+        """
+
+        try:
+            _, writer = await asyncio.open_unix_connection(self.path)
+        except OSError:
+            os.unlink(self.path)
+            return
+
+        writer.close()
+        raise OSError(
+            errno.EADDRINUSE, 'Bus socket is used by other server', self.path
+        )
+
+    def close(self) -> None:
+        self.endpoint.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle_worker(self, reader, writer):
+        hello = await reader.readline()
+        if not hello:
+            # check of other starting supervisor
+            writer.close()
+            return
+
+        hello = json.loads(hello)
+        worker = hello['data']['worker']
+        self.workers[worker] = writer
+        logger.info('Worker %s joined bus', worker)
+
+        writer.write(
+            encode_message(
+                'snapshot',
+                presence={
+                    username: list(workers)
+                    for username, workers in self.presence.items()
+                }
+            )
+        )
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.dispatch(worker, json.loads(line), line)
+        except ConnectionError:
+            pass
+        finally:
+            if self.workers.get(worker) is writer:
+                del self.workers[worker]
+            self.forget(worker)
+            writer.close()
+            logger.info('Worker %s left bus', worker)
+
+    def dispatch(self, origin, message: Dict, line: bytes) -> None:
+        action = message['action']
+        data = message['data']
+
+        if action == 'presence':
+            workers = self.presence.setdefault(data['username'], set())
+            if data['online']:
+                workers.add(origin)
+            else:
+                workers.discard(origin)
+                if not workers:
+                    del self.presence[data['username']]
+            self.relay(origin, line)
+
+        elif action == 'deliver':
+            for worker in self.presence.get(data['username'], ()):
+                if worker != origin and worker in self.workers:
+                    self.workers[worker].write(line)
+
+        elif action in ('broadcast', 'revoke'):
+            self.relay(origin, line)
+
+    def relay(self, origin, line: bytes) -> None:
+        for worker, writer in self.workers.items():
+            if worker != origin:
+                writer.write(line)
+
+    def forget(self, worker) -> None:
+        """Marks users of gone worker as offline for other workers"""
+
+        for username, workers in list(self.presence.items()):
+            if worker in workers:
+                workers.discard(worker)
+                if not workers:
+                    del self.presence[username]
+                self.relay(
+                    worker,
+                    encode_message(
+                        'presence',
+                        username=username,
+                        online=False,
+                        worker=worker
+                    )
+                )
+
+
+class BusClient:
+    """
+    Worker side of bus. Publishes presence changes and messages
+    for users of other workers, passes received messages to
+    handler coroutine and keeps presence of other workers users.
+    """
+
+    def __init__(self, path: str, worker, handler) -> None:
+        self.path = path
+        self.worker = worker
+        self.handler = handler
+        # users online in other workers: {username: {worker, ...}}
+        self.remote: Dict = {}
+
+    async def start(self) -> None:
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            self.path, limit=settings.BUFFER_SIZE
+        )
+        self.publish('hello')
+        self.task = asyncio.ensure_future(self.receive())
+
+    def publish(self, action: str, **data) -> None:
+        data.update({'worker': self.worker})
+        self.writer.write(encode_message(action, **data))
+
+    def presence(self, username: str, online: bool) -> None:
+        self.publish('presence', username=username, online=online)
+
+    def deliver(self, username: str, frame: str) -> None:
+        if username in self.remote:
+            self.publish('deliver', username=username, frame=frame)
+
+    def broadcast(self, frame: str) -> None:
+        self.publish('broadcast', frame=frame)
+
+    def revoke(self, token: str) -> None:
+        self.publish('revoke', token=token)
+
+    async def receive(self) -> None:
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                logger.error('Bus hub closed connection')
+                return
+
+            message = json.loads(line)
+            try:
+                await self.dispatch(message['action'], message['data'])
+            except Exception:
+                logger.error('Bus message handling failed', exc_info=True)
+
+    async def dispatch(self, action: str, data: Dict) -> None:
+        if action == 'snapshot':
+            self.remote = {
+                username: set(workers)
+                for username, workers in data['presence'].items()
+            }
+
+        elif action == 'presence':
+            workers = self.remote.setdefault(data['username'], set())
+            if data['online']:
+                workers.add(data['worker'])
+            else:
+                workers.discard(data['worker'])
+                if not workers:
+                    del self.remote[data['username']]
+
+        else:
+            await self.handler(action, data)
+
+    def close(self) -> None:
+        self.task.cancel()
+        self.writer.close()
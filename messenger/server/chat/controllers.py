@@ -1,5 +1,7 @@
 from bson import ObjectId
 
+import settings
+from dedup import recent_messages
 from core import (
     RequestHandler,
     Response,
@@ -8,6 +10,7 @@ from mongo import (
     User,
     Chat,
     Message,
+    Delivery,
 )
 
 
@@ -84,7 +87,31 @@ class DeleteContact(RequestHandler):
             )
 
 
-class GetChat(RequestHandler):
+class ChatHistoryMixin:
+
+    def get_range(self, total: int):
+        """
+        Returns position of first requested message ('offset' - number
+        of messages client already has, negative - counted from end)
+        and max number of messages ('limit', None - all of them)
+        """
+
+        try:
+            offset = int(self.request.data.get('offset') or 0)
+        except (TypeError, ValueError):
+            offset = 0
+
+        try:
+            limit = max(int(self.request.data['limit']), 0)
+        except (KeyError, TypeError, ValueError):
+            limit = None
+
+        if offset < 0:
+            offset = total + offset
+        return max(offset, 0), limit
+
+
+class GetChat(ChatHistoryMixin, RequestHandler):
 
     model = User
 
@@ -103,6 +130,9 @@ class GetChat(RequestHandler):
             if not chat:
                 chat = Chat(participants=participants, chat_type='single')
 
+            # client has first 'offset' messages of chat in local store
+            offset, limit = self.get_range(len(chat.messages))
+
             response = Response(
                 self.request,
                 data={
@@ -110,13 +140,15 @@ class GetChat(RequestHandler):
                     'chat_id': chat.id,
                     'contact_user_id': contact.id,
                     'contact_username': contact.username,
-                    'lenght': 0
+                    'lenght': 0,
+                    'offset': offset,
+                    'total': len(chat.messages)
                 }
             )
 
-            if chat.messages:
+            if len(chat.messages) > offset:
 
-                messages = chat.get_messages()
+                messages = chat.get_messages(offset, limit)
                 response.data.update(
                     {'messages': messages, 'lenght': len(messages)}
                 )
@@ -124,7 +156,7 @@ class GetChat(RequestHandler):
             return response
 
 
-class CommonChat(RequestHandler):
+class CommonChat(ChatHistoryMixin, RequestHandler):
 
     model = Chat
 
@@ -135,13 +167,16 @@ class CommonChat(RequestHandler):
             common_chat = self.model.get_common_chat()
             user = User.get_user(self.request.data.get('username'))
 
+            offset, limit = self.get_range(len(common_chat.messages))
             data = {
                 'code': 200,
                 'chat_id': common_chat.id,
+                'offset': offset,
+                'total': len(common_chat.messages)
             }
 
-            if common_chat.messages:
-                messages = common_chat.get_messages()
+            if len(common_chat.messages) > offset:
+                messages = common_chat.get_messages(offset, limit)
                 data.update(
                     {'messages': messages, 'lenght': len(messages)}
                 )
@@ -153,6 +188,11 @@ class CommonChat(RequestHandler):
 
 
 class AddMessage(RequestHandler):
+    """
+    Adds message to chat. Message with client message id ('message_id')
+    which was added already is not added again, response to it has
+    'duplicate' flag and is not pushed to other clients.
+    """
 
     model = Chat
 
@@ -160,30 +200,162 @@ class AddMessage(RequestHandler):
 
         if self.validate_request():
 
+            sender_id = ObjectId(self.request.data.get('user_id'))
+            message_id = self.request.data.get('message_id')
+
+            if message_id:
+                sent = recent_messages.get(sender_id, message_id)
+                if sent:
+                    return self.response(*sent, duplicate=True)
+
             chat = self.model.get_by_id(self.request.data.get('chat_id'))
-            message = Message(
-                sender_id=ObjectId(self.request.data.get('user_id')),
-                chat_id=chat._id,
-                text=self.request.data.get('message')
+
+            if chat.chat_type != 'common' and not (
+                    self.request.data.get('contact_username')
+                    and self.request.data.get('contact_user_id')
+            ):
+                return Response(
+                    self.request,
+                    {'code': 205, 'info': 'Recipient of message is not set'}
+                )
+
+            fields = {
+                'sender_id': sender_id,
+                'chat_id': chat._id,
+                'text': self.request.data.get('message')
+            }
+            if message_id:
+                fields.update({'client_id': message_id})
+
+            message, created = Message.get_or_create(**fields)
+
+            # previous attempt could stop (deadline) after message
+            # was created but before it was added to chat
+            seq = chat.add_message(message, once=not created)
+            duplicate = seq is None
+            if duplicate:
+                seq = chat.get_seq(message._id)
+
+            contact_id = self.request.data.get('contact_user_id')
+            if contact_id and seq:
+                # private message waits for recipient acknowledgement,
+                # it is queued before message is remembered as sent,
+                # so retry after deadline queues it too
+                Delivery.enqueue(
+                    ObjectId(contact_id), chat._id, seq, message._id
+                )
+
+            if message_id:
+                recent_messages.add(sender_id, message_id, chat.id, seq)
+
+            if duplicate:
+                return self.response(chat.id, seq, duplicate=True)
+
+            return self.response(chat.id, seq, chat_type=chat.chat_type)
+
+    def response(self, chat_id, seq, duplicate=False, chat_type=None):
+        return Response(
+            self.request,
+            data={
+                'code': 200,
+                'info': 'Message has been added to database',
+                'chat_id': chat_id,
+                'seq': seq,
+                'duplicate': duplicate,
+                # only messages of common chat are pushed to all users
+                'chat_type': chat_type,
+                'contact_username': self.request.data.get(
+                    'contact_username'
+                ),
+                'message': (
+                    self.request.data.get('username'),
+                    self.request.data.get('message')
+                )
+            }
+        )
+
+
+class Sync(RequestHandler):
+    """
+    Returns messages added to user chats after sequence numbers client
+    has: data 'chats' {chat_id: seq}. Response contains not more than
+    SYNC_PAGE_SIZE messages, client repeats request while 'more'.
+    """
+
+    model = Chat
+
+    def process(self):
+
+        if self.validate_request():
+
+            user = User.get_user(self.request.data.get('username'))
+            known = {}
+
+            for chat_id, seq in dict(
+                    self.request.data.get('chats') or {}
+            ).items():
+                try:
+                    if ObjectId.is_valid(chat_id):
+                        known[chat_id] = max(int(seq), 0)
+                except (TypeError, ValueError):
+                    pass
+
+            chats, more = self.model.get_updates(
+                known, user._id, settings.SYNC_PAGE_SIZE
             )
-            chat.add_message(message)
 
             return Response(
                 self.request,
                 data={
                     'code': 200,
-                    'info': 'Message has been added to database',
-                    'chat_id': chat.id,
-                    'contact_username': self.request.data.get(
-                        'contact_username'
-                    ),
-                    'message': (
-                        self.request.data.get('username'), message.text
-                    )
+                    'info': 'New messages were retrieved from database',
+                    'chats': chats,
+                    'more': more
                 }
             )
 
 
+class Deliveries(RequestHandler):
+    """
+    Acknowledges messages read by user (data 'ack' {chat_id: seq}).
+    Request without 'ack' or with 'after' (cursor of previous batch)
+    gets next batch of not acknowledged messages, first batch is
+    pushed by server after login and resume.
+    """
+
+    model = Delivery
+
+    def process(self):
+
+        if self.validate_request():
+
+            user = User.get_user(self.request.data.get('username'))
+            ack = {}
+
+            for chat_id, seq in dict(
+                    self.request.data.get('ack') or {}
+            ).items():
+                try:
+                    if ObjectId.is_valid(chat_id):
+                        ack[chat_id] = int(seq)
+                except (TypeError, ValueError):
+                    pass
+
+            self.model.acknowledge(user._id, ack)
+            data = {'code': 200, 'info': 'Messages were acknowledged'}
+
+            # acknowledgement only is cheap, batch is read when asked
+            after = self.request.data.get('after')
+            if not ack or 'after' in self.request.data:
+                if not ObjectId.is_valid(after):
+                    after = None
+                data['deliveries'] = self.model.get_batch(
+                    user._id, settings.DELIVERY_BATCH_SIZE, after
+                )
+
+            return Response(self.request, data=data)
+
+
 class Profile(RequestHandler):
 
     model = User
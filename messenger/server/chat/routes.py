@@ -6,7 +6,9 @@ from .controllers import (
     Profile,
     UpdateProfile,
     SearchInChat,
-    CommonChat
+    CommonChat,
+    Sync,
+    Deliveries
 )
 
 
@@ -14,9 +16,29 @@ routes = [
     {'action': 'add_contact', 'controller': AddContact},
     {'action': 'delete_contact', 'controller': DeleteContact},
     {'action': 'get_chat', 'controller': GetChat},
-    {'action': 'add_message', 'controller': AddMessage},
+    {
+        'action': 'add_message',
+        'controller': AddMessage,
+        'rate_limit': {'rate': 5, 'burst': 20}
+    },
     {'action': 'profile', 'controller': Profile},
     {'action': 'update_profile', 'controller': UpdateProfile},
-    {'action': 'search_in_chat', 'controller': SearchInChat},
-    {'action': 'common_chat', 'controller': CommonChat}
+    {
+        'action': 'search_in_chat',
+        'controller': SearchInChat,
+        'rate_limit': {'rate': 0.5, 'burst': 5}
+    },
+    {'action': 'common_chat', 'controller': CommonChat},
+    {
+        'action': 'sync',
+        'controller': Sync,
+        'rate_limit': {'rate': 1, 'burst': 10}
+    },
+    {
+        'action': 'deliveries',
+        'controller': Deliveries,
+        'rate_limit': {'rate': 2, 'burst': 20},
+        # first batch is pushed after login and resume
+        'session_push': True
+    }
 ]
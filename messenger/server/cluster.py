@@ -0,0 +1,232 @@
+import json
+import time
+import hmac
+import hashlib
+import asyncio
+from logging import getLogger
+from typing import Dict
+
+import settings
+from bus import encode_message
+
+
+logger = getLogger('server_logger')
+
+
+def sign_hello(node: str, timestamp: float) -> str:
+    """Signature of 'hello' proving that node knows SESSION_SECRET"""
+
+    return hmac.new(
+        settings.SESSION_SECRET.encode(),
+        '{}:{}'.format(node, timestamp).encode(),
+        hashlib.sha256
+    ).hexdigest()
+
+
+class Peer:
+    """
+    Outgoing link to other cluster node. Link is opened again with
+    growing delay when it fails, messages published while link is down
+    are dropped (node gets presence snapshot after reopening).
+    """
+
+    def __init__(self, name: str, host: str, port: int, greeting) -> None:
+        self.name = name
+        self.host = host
+        self.port = port
+        # returns frames sent first after link is opened
+        self.greeting = greeting
+        self.writer = None
+
+    async def run(self) -> None:
+        delay = settings.CLUSTER_RETRY_MIN
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    self.host, self.port
+                )
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.CLUSTER_RETRY_MAX)
+                continue
+
+            logger.info('Linked to node %s', self.name)
+            delay = settings.CLUSTER_RETRY_MIN
+            writer.write(b''.join(self.greeting()))
+            self.writer = writer
+
+            try:
+                # link is one way, reading only detects closing
+                while await reader.read(settings.BUFFER_SIZE):
+                    pass
+            except ConnectionError:
+                pass
+            finally:
+                self.writer = None
+                writer.close()
+                logger.warning('Link to node %s lost', self.name)
+
+    def send(self, line: bytes) -> None:
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(line)
+
+
+class ClusterNode:
+    """
+    Server side of cluster of server nodes (full mesh, every node
+    links to all others). Keeps presence directory of users online
+    on other nodes: {username: {node, ...}}, so messages for user are
+    forwarded only to nodes where user is online. Node which lost its
+    link is removed from directory. Links of nodes without the same
+    SESSION_SECRET (not signed 'hello') are closed at once.
+    """
+
+    def __init__(
+            self, name: str, host: str, port: int, peers: Dict,
+            local_users, handler
+    ) -> None:
+        self.name = name
+        self.host = host
+        self.port = port
+        # returns usernames online on this node
+        self.local_users = local_users
+        self.handler = handler
+        self.directory: Dict = {}
+        self.peers = {
+            node: Peer(node, peer_host, peer_port, self.greeting)
+            for node, (peer_host, peer_port) in peers.items()
+        }
+
+    async def start(self) -> None:
+        self.endpoint = await asyncio.start_server(
+            self.handle_node, host=self.host, port=self.port,
+            limit=settings.BUFFER_SIZE
+        )
+        self.tasks = [
+            asyncio.ensure_future(peer.run()) for peer in self.peers.values()
+        ]
+
+    def greeting(self):
+        now = time.time()
+        return [
+            encode_message(
+                'hello', node=self.name, time=now,
+                signature=sign_hello(self.name, now)
+            ),
+            encode_message('snapshot', users=list(self.local_users())),
+        ]
+
+    def publish(self, action: str, nodes=None, **data) -> None:
+        """Sends message to given nodes (all nodes by default)"""
+
+        line = encode_message(action, **data)
+        for node in self.peers if nodes is None else nodes:
+            peer = self.peers.get(node)
+            if peer:
+                peer.send(line)
+
+    def presence(self, username: str, online: bool) -> None:
+        self.publish('presence', username=username, online=online)
+
+    def deliver(self, username: str, frame: str) -> None:
+        nodes = self.directory.get(username)
+        if nodes:
+            self.publish(
+                'deliver', nodes=list(nodes), username=username, frame=frame
+            )
+
+    def broadcast(self, frame: str) -> None:
+        self.publish('broadcast', frame=frame)
+
+    def revoke(self, token: str) -> None:
+        self.publish('revoke', token=token)
+
+    async def handle_node(self, reader, writer):
+        node = self.authenticate(await reader.readline())
+        if not node:
+            logger.warning(
+                'Node link from %s rejected, hello is not signed',
+                writer.get_extra_info('peername')
+            )
+            writer.close()
+            return
+
+        logger.info('Node %s joined cluster', node)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                message = json.loads(line)
+                try:
+                    await self.dispatch(
+                        node, message['action'], message['data']
+                    )
+                except Exception:
+                    logger.error(
+                        'Cluster message handling failed', exc_info=True
+                    )
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.forget(node)
+            writer.close()
+            logger.warning('Node %s left cluster', node)
+
+    @staticmethod
+    def authenticate(hello: bytes) -> str:
+        """
+        Returns name of node from 'hello' signed with the same secret
+        not earlier than CLUSTER_HELLO_MAX_AGE seconds ago or None
+        """
+
+        try:
+            data = json.loads(hello)['data']
+            node, timestamp = data['node'], float(data['time'])
+            signature = data['signature'].encode()
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+        if not isinstance(node, str):
+            return None
+
+        if abs(time.time() - timestamp) > settings.CLUSTER_HELLO_MAX_AGE:
+            return None
+
+        expected = sign_hello(node, data['time']).encode()
+        if hmac.compare_digest(signature, expected):
+            return node
+
+    async def dispatch(self, node: str, action: str, data: Dict) -> None:
+        if action == 'snapshot':
+            self.forget(node)
+            for username in data['users']:
+                self.directory.setdefault(username, set()).add(node)
+
+        elif action == 'presence':
+            nodes = self.directory.setdefault(data['username'], set())
+            if data['online']:
+                nodes.add(node)
+            else:
+                nodes.discard(node)
+                if not nodes:
+                    del self.directory[data['username']]
+
+        else:
+            await self.handler(action, data)
+
+    def forget(self, node: str) -> None:
+        """Removes node from presence directory"""
+
+        for username, nodes in list(self.directory.items()):
+            nodes.discard(node)
+            if not nodes:
+                del self.directory[username]
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.endpoint.close()
@@ -0,0 +1,177 @@
+import sys
+import time
+import itertools
+from typing import Dict, List
+
+from presence import Presence
+from metrics import (
+    active_connections,
+    online_users,
+    connections_memory,
+    bytes_sent,
+)
+
+
+class Connection:
+    """State of one client connection"""
+
+    __slots__ = (
+        'id',
+        'reader',
+        'writer',
+        'address',
+        'username',
+        'opened',
+        'last_activity',
+        'bytes_in',
+        'bytes_out',
+        'buckets',
+    )
+
+    def __init__(self, id: int, reader, writer) -> None:
+        self.id = id
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.username = None
+        self.opened = self.last_activity = time.monotonic()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = {}
+
+    def __repr__(self):
+        return '<Connection {} {} {}>'.format(
+            self.id, self.address, self.username
+        )
+
+    @property
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    def touch(self, size: int = 0) -> None:
+        """Registers activity (received data) on connection"""
+        self.last_activity = time.monotonic()
+        self.bytes_in += size
+
+    def write(self, data: bytes) -> None:
+        self.writer.write(data)
+        self.bytes_out += len(data)
+        bytes_sent.inc(len(data))
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def abort(self) -> None:
+        """Closes connection without flushing write buffer"""
+        self.writer.transport.abort()
+
+
+class ConnectionRegistry:
+    """
+    Keeps opened client connections and usernames bound to them,
+    bound connections are sessions of users in presence registry
+    (user can be logged in with several connections at once).
+    Connection must be unregistered when it is closed by any reason,
+    unregistering also unbinds its user.
+    """
+
+    def __init__(self) -> None:
+        self.connections: Dict[int, Connection] = {}
+        self.presence = Presence()
+        self.counter = itertools.count(1)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(list(self.connections.values()))
+
+    def register(self, reader, writer) -> Connection:
+        connection = Connection(next(self.counter), reader, writer)
+        self.connections[connection.id] = connection
+        active_connections.set(len(self.connections))
+        return connection
+
+    def unregister(self, connection: Connection) -> str:
+        """
+        Removes connection from registry.
+        Returns username if user of connection went offline, so caller
+        can inform about it.
+        """
+        self.connections.pop(connection.id, None)
+        active_connections.set(len(self.connections))
+
+        username = connection.username
+        if self.unbind(connection):
+            return username
+
+    def bind(self, connection: Connection, username: str) -> bool:
+        """
+        Binds user to connection after login.
+        Returns True if user came online.
+        """
+
+        connection.username = username
+        online = self.presence.add(username, connection)
+        online_users.set(len(self.presence))
+        return online
+
+    def unbind(self, connection: Connection) -> bool:
+        """
+        Unbinds user from connection after logout or disconnection.
+        Returns True if user went offline.
+        """
+
+        username = connection.username
+        if not username:
+            return False
+
+        connection.username = None
+        offline = self.presence.remove(username, connection)
+        online_users.set(len(self.presence))
+        return offline
+
+    def sessions(self, username: str) -> List[Connection]:
+        """Returns all connections of user"""
+        return list(self.presence.sessions.get(username, ()))
+
+    def clients(self) -> List[Connection]:
+        """Returns all connections bound to users"""
+        return [
+            connection
+            for sessions in self.presence.sessions.values()
+            for connection in sessions
+        ]
+
+    def memory(self) -> Dict:
+        """
+        Approximate memory used by connections: size of connection
+        state objects and data waiting in transports write buffers.
+        """
+        state = sum(
+            sys.getsizeof(connection)
+            for connection in self.connections.values()
+        )
+        buffers = sum(
+            connection.writer.transport.get_write_buffer_size()
+            for connection in self.connections.values()
+        )
+        return {
+            'connections': len(self.connections),
+            'clients': len(self.presence),
+            'state_bytes': state + sys.getsizeof(self.connections)
+            + sys.getsizeof(self.presence.sessions),
+            'write_buffer_bytes': buffers,
+        }
+
+    def collect(self) -> None:
+        """Updates memory metrics, used as metrics collector"""
+
+        memory = self.memory()
+        connections_memory.set(memory['state_bytes'], kind='state')
+        connections_memory.set(
+            memory['write_buffer_bytes'], kind='write_buffer'
+        )
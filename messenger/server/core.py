@@ -1,3 +1,4 @@
+import os
 import json
 import re
 from dis import code_info
@@ -9,15 +10,50 @@ from argparse import Namespace
 from importlib import import_module
 from functools import reduce
 import asyncio
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 import settings
 from observers import (
-    BaseNotifier
+    BaseNotifier,
+    Lazy
 )
+from tracing import tracer
+from logs import redacted_payload
+from metrics import (
+    metrics,
+    requests_total,
+    responses_total,
+    bytes_received,
+    request_latency,
+    requests_in_flight,
+    shed_load,
+    rate_limited,
+)
+from connections import ConnectionRegistry
+from ratelimit import RateLimiter
+from bus import BusClient
+from cluster import ClusterNode
+import deadlines
+from sessions import sessions
 
 
 logger = getLogger('server_logger')
 
+# every request and response is one json document followed by newline
+FRAME_END = b'\n'
+
+# actions handled by server itself without routing and controllers
+CONTROL_ACTIONS = ('ping', 'pong')
+
+# actions binding user to connection when they succeed
+SESSION_ACTIONS = ('login', 'resume')
+
+# metrics label of actions missing in routes, so clients can not
+# create unbounded number of label values
+UNKNOWN_ACTION = 'unknown'
+
 
 class SingletonMeta(type):
     """Singleton realisation with metaclass"""
@@ -40,11 +76,22 @@ class Request:
 
     action = None
     data: Dict = {}
+    # seconds client waits for response
+    timeout: float = None
+    # server time of receiving, set by server
+    received: float = None
+    # any id chosen by client, it is echoed in response 'request_id'
+    id = None
+    # client time of sending
+    time = None
+
+    # envelope fields taken from client frame, other keys are ignored
+    fields = ('action', 'data', 'timeout', 'id', 'time')
 
     def __init__(self, **kwargs):
         [
             setattr(self, attr, value) for attr, value in kwargs.items()
-            if hasattr(self, attr)
+            if attr in self.fields
         ]
 
     def is_valid(self):
@@ -52,6 +99,14 @@ class Request:
             return False
         return True
 
+    def budget(self):
+        """Returns client timeout in seconds, None if it is wrong or not set"""
+
+        valid = isinstance(self.timeout, (int, float)) and not isinstance(
+            self.timeout, bool
+        )
+        return self.timeout if valid else None
+
 
 class Response:
     """Base response class"""
@@ -63,22 +118,48 @@ class Response:
 
     def __init__(self, request: Request, data: Dict = {}) -> None:
 
-        if bool(self.data):
-            self.data.clear()
-
-        self.data.update(
-            {
-                'action': request.action,
-                'timestamp': self.time,
-                'code': self.code,
-                'info': self.info,
-            }
-        )
+        self.data = {
+            'action': request.action,
+            'timestamp': self.time,
+            'code': self.code,
+            'info': self.info,
+        }
+        if request.id is not None:
+            self.data['request_id'] = request.id
         self.data.update(**data)
 
-    def prepare(self):
+    def prepare(self, push: bool = False):
+        if push and 'request_id' in self.data:
+            return json.dumps(
+                {
+                    key: value for key, value in self.data.items()
+                    if key != 'request_id'
+                }
+            )
         return json.dumps(self.data)
 
+    def encode(self, encoding_name: str, push: bool = False) -> bytes:
+        """
+        Returns response as frame ready to be written to client.
+        Push frames (sent to other clients) have no request id.
+        """
+
+        return json.dumps(self.prepare(push)).encode(encoding_name) + FRAME_END
+
+
+class Ping(Response):
+    """Heartbeat sent by server to idle connections"""
+
+    def __init__(self) -> None:
+        super().__init__(Request(action='ping'))
+
+
+class Pong(Response):
+    """Answer to client heartbeat"""
+
+    def __init__(self) -> None:
+        super().__init__(Request(action='pong'))
+
 
 class Response_400(Response):
 
@@ -104,6 +185,24 @@ class Response_500(Response):
     info = 'Internal server error'
 
 
+class Response_429(Response):
+
+    code = 429
+    info = 'Too many requests'
+
+
+class Response_503(Response):
+
+    code = 503
+    info = 'Server is busy, try later'
+
+
+class Response_504(Response):
+
+    code = 504
+    info = 'Request deadline exceeded'
+
+
 class RequestHandler(ABC):
     """
     Interface for all request handlers classes.
@@ -114,7 +213,7 @@ class RequestHandler(ABC):
 
     def __init__(self, request: Request) -> None:
         self.request = request
-        logger.info('Controller: "{}" was called.'.format(self))
+        logger.info('Controller: "%s" was called.', self)
 
     @abstractmethod
     def process(self) -> Response:
@@ -134,10 +233,13 @@ class Router(Singleton):
     (gets action from request and return appropriate controller)
     """
 
+    table = None
+    pushes = None
+
     def server_routes(self):
         """
         Return list of all routes from each module
-        in INSTALLED_MODULES - [ {action: controller}, ... ]
+        in INSTALLED_MODULES - [ {action: controller, **options}, ... ]
         """
 
         return reduce(
@@ -159,6 +261,19 @@ class Router(Singleton):
             for route in self.server_routes()
         }
 
+    def route(self, action):
+        """
+        Return route dict (controller and route options like 'rate_limit')
+        for passed action or None if action not exists in routes.
+        Routes table is built once on first call.
+        """
+
+        if self.table is None:
+            self.table = {
+                route['action']: route for route in self.server_routes()
+            }
+        return self.table.get(action)
+
     def actions(self):
         """
         Return list of all possible actions from 'self.routes'
@@ -173,7 +288,7 @@ class Router(Singleton):
         or returns 'False' otherwise
         """
 
-        if action in self.actions():
+        if self.route(action):
             return True
 
     def resolve(self, action):
@@ -183,7 +298,21 @@ class Router(Singleton):
         Return None if passed action not exists in routes.
         """
 
-        return self.routes_map().get(action, None)
+        route = self.route(action)
+        return route['controller'] if route else None
+
+    def session_pushes(self):
+        """
+        Return actions of routes with 'session_push' option, their
+        responses are pushed to client after login and resume
+        """
+
+        if self.pushes is None:
+            self.pushes = [
+                route['action'] for route in self.server_routes()
+                if route.get('session_push')
+            ]
+        return self.pushes
 
 
 class PortDescriptor:
@@ -214,6 +343,12 @@ class Settings(Singleton):
     buffer_size = 1024
     encoding_name = 'utf-8'
     connections = 5
+    max_in_flight = 16
+    metrics_port = None
+    node_name = None
+    cluster_host = 'localhost'
+    cluster_port = None
+    cluster_peers = {}
 
     def __init__(self) -> None:
         for attr, value in self.__class__.__dict__.items():
@@ -273,30 +408,89 @@ class ServerVerifier(type):
 class Server(metaclass=ServerVerifier):
 
     state = 'Disconnected'
+    # worker number when server is run by supervisor in worker process
+    worker = None
 
     def __init__(self, namespace: Namespace = None):
         self.settings = Settings()
         self.router = Router()
         self.notifier = BaseNotifier(self)
+        self.in_flight = 0
+        self.busy_frames = {}
+        self.limited_frames = {}
+        self.limiter = RateLimiter()
+        # bus of workers and cluster of nodes, both forward presence
+        # and messages to users connected to other processes
+        self.relays = []
+
+    @property
+    def bus_path(self) -> str:
+        """Unix socket of workers bus, every server port has own bus"""
+
+        return settings.BUS_PATH.format(port=self.settings.port)
 
     def run(self):
         asyncio.set_event_loop(asyncio.new_event_loop())
         loop = asyncio.get_event_loop()
 
-        loop.connections = []
-        loop.clients = {}
+        self.connections = ConnectionRegistry()
+        metrics.add_collector('connections', self.connections.collect)
+
+        # controllers (blocking database calls) are executed in threads,
+        # number of threads limits number of requests processed at once
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.settings.max_in_flight,
+            thread_name_prefix='controller'
+        )
 
+        # workers share listening port, kernel balances connections
         endpoint_factory = asyncio.start_server(
             self.handle_connection,
             host=self.settings.host,
             port=self.settings.port,
+            limit=self.settings.buffer_size,
+            reuse_port=self.worker is not None,
         )
 
         self.endpoint = loop.run_until_complete(endpoint_factory)
         self.state = 'Connected'
 
-        info = 'Server started with {0}:{1}'.format(
-            self.settings.host, self.settings.port
+        if self.worker is not None:
+            tracer.pid = os.getpid()
+            tracer.worker = self.worker
+            bus = BusClient(self.bus_path, self.worker, self.handle_relayed)
+            loop.run_until_complete(bus.start())
+            self.relays.append(bus)
+
+        if self.settings.cluster_peers:
+            cluster = ClusterNode(
+                self.settings.node_name,
+                self.settings.cluster_host,
+                self.settings.cluster_port,
+                self.settings.cluster_peers,
+                self.connections.presence.users,
+                self.handle_relayed
+            )
+            loop.run_until_complete(cluster.start())
+            self.relays.append(cluster)
+
+        if self.settings.metrics_port:
+            self.metrics_endpoint = loop.run_until_complete(
+                asyncio.start_server(
+                    self.handle_metrics,
+                    host=self.settings.host,
+                    port=self.settings.metrics_port + (self.worker or 0),
+                )
+            )
+
+        self.reaper = loop.create_task(self.reap_idle_connections())
+
+        if settings.PRESENCE_SNAPSHOT_INTERVAL:
+            self.snapshots = loop.create_task(self.snapshot_presence())
+
+        info = 'Server started with {0}:{1}{2}'.format(
+            self.settings.host, self.settings.port,
+            '' if self.worker is None else ' (worker {})'.format(self.worker)
         )
         logger.info(info)
         self.notifier.notify('log', info=info)
@@ -316,101 +510,465 @@ class Server(metaclass=ServerVerifier):
     async def handle_connection(self, reader, writer):
         """
         Handles connections: reads from reader stream, writes to writer stream.
+        Connection is removed from registry when client disconnects
+        or connection fails.
         """
 
-        address = writer.get_extra_info('peername')
-        info = 'Client with address {} detected'.format(address)
+        if len(self.connections) >= self.settings.connections:
+            shed_load.inc(reason='connections')
+            logger.warning(
+                'Client %s rejected, connections limit reached',
+                writer.get_extra_info('peername')
+            )
+            writer.write(self.busy_frame(None))
+            writer.close()
+            return
+
+        connection = self.connections.register(reader, writer)
+        info = 'Client with address {} detected'.format(connection.address)
         logger.info(info)
         self.notifier.notify('log', info=info)
 
+        try:
+            while True:
+                try:
+                    raw_request = await reader.readline()
+                except ValueError:
+                    logger.error(
+                        'Client %s sent request exceeding buffer size',
+                        connection.address
+                    )
+                    return
+
+                if raw_request.strip():
+                    connection.touch(len(raw_request))
+                    bytes_received.inc(len(raw_request))
+                    tracer.start_request()
+
+                    with tracer.span('request'):
+                        await self.handle_request(raw_request, connection)
+                elif not raw_request:
+                    logger.info('Client %s disconnected', connection.address)
+                    return
+        except ConnectionError as error:
+            logger.info(
+                'Client %s connection lost: %s', connection.address, error
+            )
+        finally:
+            self.release(connection)
+
+    def release(self, connection):
+        """Closes connection and removes it from registry"""
+
+        connection.close()
+        username = self.connections.unregister(connection)
+
+        if username:
+            self.user_offline(username)
+
+    def user_online(self, connection, username: str) -> None:
+        """
+        Binds user to connection, informs gui and other workers
+        if user came online (it is first session of user)
+        """
+
+        previous = connection.username
+        if previous == username:
+            return
+
+        if previous and self.connections.unbind(connection):
+            self.user_offline(previous)
+
+        if not self.connections.bind(connection, username):
+            return
+
+        self.notifier.notify('client', action='add', data=username)
+
+        for relay in self.relays:
+            relay.presence(username, True)
+
+    def user_offline(self, username: str) -> None:
+        self.notifier.notify('client', action='delete', data=username)
+
+        for relay in self.relays:
+            relay.presence(username, False)
+
+    async def handle_relayed(self, action: str, data) -> None:
+        """Handles messages forwarded by other workers or nodes"""
+
+        if action == 'deliver':
+            await self.fan_out(
+                self.connections.sessions(data['username']),
+                data['frame'].encode(self.settings.encoding_name)
+            )
+
+        elif action == 'broadcast':
+            await self.fan_out(
+                self.connections.clients(),
+                data['frame'].encode(self.settings.encoding_name)
+            )
+
+        elif action == 'revoke':
+            sessions.revoke(data['token'])
+
+    async def reap_idle_connections(self):
+        """
+        Sends 'ping' to connections idle for more than heartbeat interval
+        and drops connections idle for more than idle timeout
+        (half-open connections of vanished clients).
+        """
+
+        ping = Ping().encode(self.settings.encoding_name)
+
+        while True:
+            await asyncio.sleep(settings.HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+
+            for connection in self.connections:
+                idle = now - connection.last_activity
+
+                if idle > settings.IDLE_TIMEOUT:
+                    info = 'Client {} reaped after {:.0f}s of silence'.format(
+                        connection.address, idle
+                    )
+                    logger.info(info)
+                    self.notifier.notify('log', info=info)
+                    connection.abort()
+                    self.release(connection)
+
+                elif idle > settings.HEARTBEAT_INTERVAL:
+                    connection.write(ping)
+
+            self.limiter.prune()
+
+    async def snapshot_presence(self):
+        """
+        Writes users online on this server to file periodically,
+        file is written in thread to not block event loop.
+        """
+
         loop = asyncio.get_event_loop()
-        loop.connections.append(writer)
+        path = settings.PRESENCE_SNAPSHOT_FILE.format(
+            worker=self.worker or 0
+        )
 
         while True:
-            raw_request = await reader.read(self.settings.buffer_size)
+            await asyncio.sleep(settings.PRESENCE_SNAPSHOT_INTERVAL)
+            snapshot = self.connections.presence.snapshot()
+            snapshot.update(
+                {'node': self.settings.node_name, 'worker': self.worker}
+            )
+
+            try:
+                await loop.run_in_executor(
+                    None, self.connections.presence.save, snapshot, path
+                )
+            except OSError:
+                logger.error('Presence snapshot failed', exc_info=True)
 
-            if raw_request:
+    def busy_frame(self, action, request_id=None) -> bytes:
+        """
+        Returns prepared 'server is busy' response for action,
+        frames without request id are cached so rejecting requests
+        costs almost nothing.
+        """
+
+        return self.rejection_frame(
+            Response_503, self.busy_frames, action, request_id
+        )
+
+    def limited_frame(self, action, request_id=None) -> bytes:
+        """Returns prepared 'too many requests' response for action"""
+
+        return self.rejection_frame(
+            Response_429, self.limited_frames, action, request_id
+        )
+
+    def rejection_frame(self, response_class, cache, action, request_id):
+        request = Request(action=action, id=request_id)
+
+        # only frames of known actions (and of requests not read yet,
+        # like connections over limit) are cached
+        known = action is None or self.router.route(action)
+        if request_id is not None or not known:
+            return response_class(request).encode(self.settings.encoding_name)
+
+        if action not in cache:
+            cache[action] = response_class(request).encode(
+                self.settings.encoding_name
+            )
+        return cache[action]
+
+    async def handle_control(self, request, connection):
+        """Answers client heartbeats, every frame already updated activity"""
+
+        if request.action == 'ping':
+            connection.write(Pong().encode(self.settings.encoding_name))
+            await connection.drain()
+
+    async def deliver_message(
+            self, connection, client, frame: bytes, common: bool = False
+    ):
+        """
+        Delivers new message to every session of recipient (of all
+        users for common chat) and to other sessions of sender,
+        in this process and in other workers and nodes.
+        Private message without recipient goes to sender only.
+        """
+
+        sender = connection.username
+
+        if common:
+            recipients = self.connections.clients()
+        else:
+            recipients = self.connections.sessions(sender) if sender else []
+            if client and client != sender:
+                recipients += self.connections.sessions(client)
+
+        await self.fan_out(
+            [
+                recipient for recipient in recipients
+                if recipient is not connection
+            ],
+            frame
+        )
+
+        if self.relays:
+            frame = frame.decode(self.settings.encoding_name)
+
+        for relay in self.relays:
+            if common:
+                relay.broadcast(frame)
+                continue
+
+            for username in {client, sender} - {None}:
+                relay.deliver(username, frame)
+
+    async def fan_out(self, connections, data: bytes) -> None:
+        """
+        Writes the same data to connections and waits until all of
+        them are drained at once, not one after another.
+        """
+
+        await asyncio.gather(
+            *[self.send(connection, data) for connection in connections]
+        )
+
+    async def send(self, connection, data: bytes) -> None:
+        """
+        Writes data to other client connection.
+        Failed or closing connection is released and not awaited,
+        so broadcasts don't write to dead sockets.
+        """
+
+        if connection.is_closing:
+            self.release(connection)
+            return
+
+        try:
+            connection.write(data)
+            await connection.drain()
+        except ConnectionError:
+            self.release(connection)
+
+    async def handle_metrics(self, reader, writer):
+        """
+        Minimal http endpoint returning server metrics
+        in prometheus text exposition format for any request.
+        """
+
+        await reader.readline()
+        body = metrics.render().encode(self.settings.encoding_name)
+        headers = '\r\n'.join(
+            [
+                'HTTP/1.0 200 OK',
+                'Content-Type: text/plain; version=0.0.4',
+                'Content-Length: {}'.format(len(body)),
+                '', ''
+            ]
+        )
+        writer.write(headers.encode(self.settings.encoding_name) + body)
+        await writer.drain()
+        writer.close()
+
+    async def handle_request(self, raw_request, connection):
+        """
+        Parses raw request, processes it and writes response to
+        connection (and to other clients connections for new messages).
+        """
+
+        start = time.perf_counter()
+
+        with tracer.span('parse'):
+            try:
                 request_as_string = raw_request.decode(
                     self.settings.encoding_name
                 )
+                request_attributes = json.loads(request_as_string)
+                request = Request(**request_attributes)
+            except (ValueError, TypeError, AttributeError):
+                # not decodable, not json or not json object
+                request = None
+            else:
+                request.received = time.time()
+
+            wrong_fields = request and (
+                not isinstance(request.action, (str, type(None)))
+                or not isinstance(request.data, dict)
+            )
+            if wrong_fields:
+                request = None
+
+        if request is None:
+            logger.warning(
+                'Client %s sent malformed request', connection.address
+            )
+            requests_total.inc(action=UNKNOWN_ACTION)
+            responses_total.inc(action=UNKNOWN_ACTION, code=400)
+            connection.write(
+                Response_400(Request()).encode(self.settings.encoding_name)
+            )
+            await connection.drain()
+            return
+
+        if request.action in CONTROL_ACTIONS:
+            await self.handle_control(request, connection)
+            return
+
+        route = self.router.route(request.action)
+        limit = route.get('rate_limit') if route else None
+        label = request.action if route else UNKNOWN_ACTION
+
+        requests_total.inc(action=label)
+
+        allowed = not limit or self.limiter.allow(
+            connection, request.action, limit, request.data.get('username')
+        )
+        if not allowed:
+            rate_limited.inc(action=label)
+            connection.write(
+                self.limited_frame(request.action, request.id)
+            )
+            await connection.drain()
+            return
+
+        if self.in_flight >= self.settings.max_in_flight:
+            shed_load.inc(reason='in_flight')
+            connection.write(self.busy_frame(request.action, request.id))
+            await connection.drain()
+            return
+        logger.info(
+            'Request', extra={
+                'payload': redacted_payload(
+                    request_as_string, request_attributes
+                ),
+                'action': request.action
+            }
+        )
+
+        self.notifier.notify(
+            'request',
+            request=Lazy(
+                lambda: json.dumps(json.loads(request_as_string), indent=4)
+            )
+        )
+
+        response = await self.process_request(request)
+        prepared_response = None
+        session_user = None
 
-                logger.info('Request: {0}'.format(request_as_string))
+        if response:
+            if response.data.get('action') != 'logout':
 
-                self.notifier.notify(
-                    'request',
-                    request=json.dumps(
-                        json.loads(request_as_string),
-                        indent=4
+                if response.data.get('action') in SESSION_ACTIONS:
+                    data = response.data.get('user_data')
+                    if data:
+                        session_user = data.get('username')
+                        self.user_online(connection, session_user)
+
+                with tracer.span('serialize'):
+                    prepared_response = response.encode(
+                        self.settings.encoding_name
                     )
-                )
 
-                request_attributes = json.loads(
-                    raw_request.decode(self.settings.encoding_name)
-                )
-                request = Request(**request_attributes)
+                with tracer.span('write'):
+                    new_message = (
+                        response.data.get('action') == 'add_message'
+                        # errors are answered to sender only
+                        and response.data.get('code') == 200
+                        # retried message was pushed already
+                        and not response.data.get('duplicate')
+                    )
+                    if new_message:
+                        push = prepared_response
+                        if request.id is not None:
+                            push = response.encode(
+                                self.settings.encoding_name, push=True
+                            )
 
-                response = await self.process_request(request)
-                if response:
-                    if response.data.get('action') != 'logout':
-
-                        if response.data.get('action') == 'login':
-                            data = response.data.get('user_data')
-                            if data:
-                                loop.clients.update(
-                                    {data.get('username'): writer}
-                                )
-                                self.notifier.notify(
-                                    'client',
-                                    action='add',
-                                    data=data.get('username')
-                                )
-
-                        prepared_response = json.dumps(
-                            response.prepare()
-                        ).encode(self.settings.encoding_name)
-
-                        if response.data.get('action') == 'add_message':
-                            client = response.data.get('contact_username')
-
-                            if not client:
-                                for client in loop.clients:
-                                    client_writer = loop.clients[client]
-
-                                    if client_writer is not writer:
-                                        client_writer.write(prepared_response)
-                                        await client_writer.drain()
-                            else:
-                                if client in loop.clients:
-                                    client_write = loop.clients[client]
-                                    client_write.write(
-                                        prepared_response
-                                    )
-                                    await client_write.drain()
-
-                        writer.write(prepared_response)
-                        await writer.drain()
-                    else:
-                        user = response.data.get('username')
-                        loop.clients.pop(user)
-                        self.notifier.notify(
-                            'client',
-                            action='delete',
-                            data=user
+                        await self.deliver_message(
+                            connection,
+                            response.data.get('contact_username'),
+                            push,
+                            response.data.get('chat_type') == 'common'
                         )
 
-                logger.info('Response {} sent.'.format(response))
-                logger.info(prepared_response)
+                    connection.write(prepared_response)
+                    await connection.drain()
 
-                self.notifier.notify(
-                    'response',
-                    response=json.dumps(
-                        response.data, indent=4
-                    )
-                )
+                if session_user:
+                    await self.push_session(connection, session_user)
             else:
-                writer.close()
-                logger.info('Client {} disconnected'.format(address))
-                return
+                user = response.data.get('username')
+                if connection.username == user:
+                    if self.connections.unbind(connection):
+                        self.user_offline(user)
+
+                token = request.data.get('token')
+                if token:
+                    for relay in self.relays:
+                        relay.revoke(token)
+
+            self.notifier.notify(
+                'response',
+                response=Lazy(lambda: json.dumps(response.data, indent=4))
+            )
+
+            responses_total.inc(
+                action=label, code=response.data.get('code')
+            )
+
+        request_latency.observe(
+            time.perf_counter() - start, action=label
+        )
+
+        logger.info(
+            'Response sent', extra={
+                'payload': redacted_payload(
+                    prepared_response, response.data
+                ) if response else None,
+                'action': request.action,
+                'code': response.data.get('code') if response else None
+            }
+        )
+
+    async def push_session(self, connection, username: str) -> None:
+        """
+        Pushes responses of 'session_push' routes (like missed messages)
+        after login or resume response was written, so session itself
+        is not slowed down by them
+        """
+
+        for action in self.router.session_pushes():
+            request = Request(action=action, data={'username': username})
+            request.received = time.time()
+            response = await self.process_request(request)
+
+            if response and response.data.get('code') == 200:
+                await self.send(
+                    connection,
+                    response.encode(self.settings.encoding_name)
+                )
 
     async def process_request(self, request):
         """Processing received request from client"""
@@ -418,12 +976,32 @@ class Server(metaclass=ServerVerifier):
         if request.is_valid():
             action = request.action
 
-            if self.router.validate_action(action):
-                controller = self.router.resolve(action)
+            with tracer.span('route', action=action):
+                valid = self.router.validate_action(action)
+                controller = self.router.resolve(action) if valid else None
 
+            if valid:
                 if controller:
+                    route = self.router.route(action)
+                    timeout = deadlines.start(
+                        route.get('deadline', settings.REQUEST_DEADLINE),
+                        request.budget(),
+                        request.received
+                    )
+
+                    if timeout <= 0:
+                        logger.warning(
+                            'Request %s came after deadline', action
+                        )
+                        return Response_504(request)
+
                     try:
-                        return controller(request).process()
+                        return await asyncio.wait_for(
+                            self.execute(controller, request), timeout
+                        )
+                    except (asyncio.TimeoutError, deadlines.DeadlineExceeded):
+                        logger.warning('Request %s deadline exceeded', action)
+                        return Response_504(request)
                     except Exception:
                         logger.critical('Exception occurred', exc_info=True)
                         return Response_500(request)
@@ -436,13 +1014,65 @@ class Server(metaclass=ServerVerifier):
             logger.error('Request is not valid')
             return Response_400(request)
 
+    async def execute(self, controller, request):
+        """
+        Runs controller in executor thread within current context.
+        If waiting is cancelled (deadline) controller which is not
+        started yet is cancelled too. Running controller keeps its
+        in-flight slot until it really finishes.
+        """
+
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+
+        future = self.executor.submit(
+            context.run, self.run_controller, controller, request
+        )
+        self.in_flight += 1
+        requests_in_flight.set(self.in_flight)
+
+        def release_slot(future):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self.release_slot)
+
+        future.add_done_callback(release_slot)
+        return await asyncio.wrap_future(future)
+
+    def release_slot(self):
+        self.in_flight -= 1
+        requests_in_flight.set(self.in_flight)
+
+    @staticmethod
+    def run_controller(controller, request):
+        with tracer.span(
+            'controller', action=request.action,
+            controller=controller.__name__
+        ):
+            return controller(request).process()
+
     def close(self):
         if hasattr(self, 'endpoint'):
             loop = asyncio.get_event_loop()
+            self.reaper.cancel()
+            if hasattr(self, 'snapshots'):
+                self.snapshots.cancel()
             self.endpoint.close()
 
             loop.run_until_complete(self.endpoint.wait_closed())
             del self.endpoint
+            self.executor.shutdown(wait=False)
+
+            for relay in self.relays:
+                relay.close()
+            self.relays = []
+
+            if hasattr(self, 'metrics_endpoint'):
+                self.metrics_endpoint.close()
+                loop.run_until_complete(self.metrics_endpoint.wait_closed())
+                del self.metrics_endpoint
 
             self.state = 'Disconnected'
             self.notifier.notify('state')
+
+            if tracer.enabled:
+                tracer.export()
@@ -0,0 +1,38 @@
+import time
+from contextvars import ContextVar
+
+
+# unix timestamp (server clock) after which current request result
+# is not needed anymore
+request_deadline = ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when request processing continues after its deadline"""
+    pass
+
+
+def start(timeout: float, budget: float = None, received=None) -> float:
+    """
+    Binds deadline of request to current execution context.
+    Deadline is 'timeout' or smaller 'budget' passed by client
+    (seconds, so clocks of client and server may differ) counted from
+    time request was received. Returns seconds left.
+    """
+    now = time.time()
+
+    if budget is not None:
+        timeout = min(timeout, budget)
+
+    value = (received or now) + timeout
+
+    request_deadline.set(value)
+    return value - now
+
+
+def check() -> None:
+    """Raises 'DeadlineExceeded' if deadline of current request passed"""
+
+    deadline = request_deadline.get()
+    if deadline and time.time() > deadline:
+        raise DeadlineExceeded()
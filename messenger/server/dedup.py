@@ -0,0 +1,35 @@
+import threading
+from collections import OrderedDict
+
+import settings
+
+
+class RecentMessages:
+    """
+    Bounded LRU cache of recently added messages
+    {(sender id, client message id): (chat id, seq)}, so retried
+    'add_message' requests are answered without database writes.
+    Older retries are caught by unique index on messages.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.messages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sender_id, message_id):
+        with self.lock:
+            key = (sender_id, message_id)
+            if key in self.messages:
+                self.messages.move_to_end(key)
+                return self.messages[key]
+
+    def add(self, sender_id, message_id, chat_id, seq) -> None:
+        with self.lock:
+            self.messages[(sender_id, message_id)] = (chat_id, seq)
+            self.messages.move_to_end((sender_id, message_id))
+            while len(self.messages) > self.size:
+                self.messages.popitem(last=False)
+
+
+recent_messages = RecentMessages(settings.MESSAGE_DEDUP_CACHE_SIZE)
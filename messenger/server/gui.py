@@ -5,6 +5,7 @@ from typing import Dict
 from PyQt5.QtCore import (
     Qt,
     QThread,
+    QTimer,
     QStringListModel,
     pyqtSignal
 )
@@ -139,6 +140,17 @@ class ServerGui(QWidget):
 
         self.server_listener.refresh(self.server.notifier)
 
+        # log, request and response widgets are updated by timer
+        # with last payloads received from server thread
+        self.throttled_listeners = (
+            self.log_listener,
+            self.request_listener,
+            self.response_listener
+        )
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.flush_listeners)
+        self.refresh_timer.start(settings.GUI_REFRESH_INTERVAL)
+
     def init_ui(self):
 
         titles = {
@@ -256,6 +268,10 @@ class ServerGui(QWidget):
         rectangle.moveCenter(desktop_center)
         self.move(rectangle.topLeft())
 
+    def flush_listeners(self):
+        for listener in self.throttled_listeners:
+            listener.flush()
+
     def run_server(self):
 
         widgets = self.settings_group.findChildren(TitledLineEdit)
@@ -0,0 +1,218 @@
+import os
+import json
+import queue
+import random
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+import settings
+from metrics import dropped_log_records
+from tracing import current_request
+
+
+listeners = []
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records to bounded queue without blocking.
+    Records are dropped (and counted) when queue is full, so logging
+    never stalls event loop. Formatting is left to writer thread.
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_log_records.inc()
+
+    def prepare(self, record):
+        return record
+
+
+class BackgroundListener(QueueListener):
+    """Writes queued records to handlers within background thread"""
+
+    def enqueue_sentinel(self):
+        """Waits for free slot, queue can be full at the moment of stop"""
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        """Flushes queue and stops thread if it is still running"""
+        if self._thread:
+            super().stop()
+
+    def restart(self):
+        """
+        Starts writer thread in forked process (threads are not copied
+        by fork), records queued by parent process are dropped.
+        """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self._thread = None
+        self.start()
+
+
+class RecordFilter(logging.Filter):
+    """
+    Adds request id to every record and samples and truncates
+    records with 'payload' attribute (request and response bodies).
+    """
+
+    def __init__(self, sample_rate: float = 1, limit: int = None):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.limit = limit
+
+    def filter(self, record):
+        record.request_id = current_request.get()
+        payload = getattr(record, 'payload', None)
+
+        if payload is None:
+            return True
+
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+
+        if self.limit and len(payload) > self.limit:
+            record.payload = payload[:self.limit]
+            record.truncated = len(payload) - self.limit
+
+        return True
+
+
+def redact(data):
+    """
+    Returns copy of dict with values of LOG_SECRET_FIELDS (in nested
+    dicts too) hidden, dict without such fields is returned as it is.
+    """
+
+    if not isinstance(data, dict):
+        return data
+
+    hidden = {}
+    for key, value in data.items():
+        if key in settings.LOG_SECRET_FIELDS:
+            hidden[key] = '***'
+        else:
+            nested = redact(value)
+            if nested is not value:
+                hidden[key] = nested
+
+    return {**data, **hidden} if hidden else data
+
+
+def redacted_payload(payload, data):
+    """
+    Returns payload to be logged: json of data with hidden secrets
+    if data contains them, payload itself otherwise.
+    """
+
+    hidden = redact(data)
+    return payload if hidden is data else json.dumps(hidden)
+
+
+def payload_as_text(record) -> str:
+    payload = record.payload
+    if isinstance(payload, bytes):
+        payload = payload.decode(settings.ENCODING_NAME, 'replace')
+
+    truncated = getattr(record, 'truncated', None)
+    if truncated:
+        payload = '{}... [{} truncated]'.format(payload, truncated)
+    return payload
+
+
+class TextFormatter(logging.Formatter):
+    """Appends payload to formatted message if record has one"""
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        if getattr(record, 'payload', None) is not None:
+            message = '{}: {}'.format(message, payload_as_text(record))
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats record as one line json object"""
+
+    fields = ('action', 'code', 'address')
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        data.update(
+            {
+                field: getattr(record, field)
+                for field in self.fields if hasattr(record, field)
+            }
+        )
+
+        if getattr(record, 'payload', None) is not None:
+            data['payload'] = payload_as_text(record)
+
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
+
+def start_logging(logger, *handlers) -> BackgroundListener:
+    """
+    Attaches queue handler to logger and starts background thread
+    writing queued records to passed handlers.
+    """
+
+    records = queue.Queue(settings.LOG_QUEUE_SIZE)
+
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(
+        RecordFilter(
+            sample_rate=settings.LOG_PAYLOAD_SAMPLE_RATE,
+            limit=settings.LOG_PAYLOAD_LIMIT
+        )
+    )
+    logger.addHandler(queue_handler)
+
+    listener = BackgroundListener(
+        records, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    os.register_at_fork(after_in_child=listener.restart)
+    listeners.append(listener)
+
+    return listener
+
+
+def use_worker_log_file(worker: int) -> None:
+    """
+    Switches file handlers of forked worker process to its own
+    LOG_FILE, so processes don't rotate the same file.
+    """
+
+    filename = os.path.abspath(
+        settings.LOG_FILE.format(worker='_{}'.format(worker))
+    )
+    for listener in listeners:
+        for handler in listener.handlers:
+            if not isinstance(handler, logging.FileHandler):
+                continue
+            with handler.lock:
+                if handler.stream:
+                    handler.stream.close()
+                    handler.stream = None
+                # file is opened by next record
+                handler.baseFilename = filename
+
+
+def stop_logging() -> None:
+    """Writes queued records and stops writer threads"""
+
+    for listener in listeners:
+        listener.stop()
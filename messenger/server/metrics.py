@@ -0,0 +1,244 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+import settings
+
+
+class Metric:
+    """
+    Base class for metrics with labels.
+    Values are stored in dict with tuple of label values as keys.
+    """
+
+    kind = None
+
+    def __init__(self, name: str, description: str, labels: Tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def format_labels(self, key: Tuple, **extra) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{{{}}}'.format(
+            ','.join('{}="{}"'.format(label, value) for label, value in pairs)
+        )
+
+    def exposition(self):
+        """Returns lines of metric in prometheus text exposition format"""
+
+        yield '# HELP {} {}'.format(self.name, self.description)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+
+        for key, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, self.format_labels(key), value)
+
+    def snapshot(self):
+        return {
+            ','.join(key) or self.name: value
+            for key, value in self.values.items()
+        }
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets upper bounds.
+    Value of every labels set is list: [bucket counts..., sum, count].
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.buckets) + 2)
+            counts = self.values[key]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def quantile(self, q: float, counts) -> float:
+        """
+        Estimates quantile as upper bound of bucket
+        where q-th observation falls.
+        """
+        rank = q * counts[-1]
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def exposition(self):
+        yield '# HELP {} {}'.format(self.name, self.description)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+
+        for key, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name,
+                    self.format_labels(
+                        key, le='+Inf' if bound == float('inf') else bound
+                    ),
+                    cumulative
+                )
+            labels = self.format_labels(key)
+            yield '{}_sum{} {}'.format(self.name, labels, counts[-2])
+            yield '{}_count{} {}'.format(self.name, labels, counts[-1])
+
+    def snapshot(self):
+        return {
+            ','.join(key) or self.name: {
+                'count': counts[-1],
+                'sum': counts[-2],
+                'p50': self.quantile(0.5, counts),
+                'p95': self.quantile(0.95, counts),
+                'p99': self.quantile(0.99, counts),
+            }
+            for key, counts in self.values.items()
+        }
+
+
+class Metrics:
+    """Registry of all server metrics"""
+
+    def __init__(self) -> None:
+        self.registry = {}
+        self.collectors = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.registry[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()) -> Gauge:
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=()):
+        return self.register(
+            Histogram(name, description, labels, buckets=buckets)
+        )
+
+    def add_collector(self, name: str, collector) -> None:
+        """
+        Adds (or replaces by name) callable which is called before
+        metrics rendering, used for values that are cheaper to read on demand.
+        """
+        self.collectors[name] = collector
+
+    def collect(self) -> None:
+        for collector in self.collectors.values():
+            collector()
+
+    def render(self) -> str:
+        """Returns all metrics in prometheus text exposition format"""
+
+        self.collect()
+        lines = []
+        for metric in self.registry.values():
+            lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict:
+        """Returns all metrics values as json serializable dict"""
+
+        self.collect()
+        return {
+            name: metric.snapshot()
+            for name, metric in self.registry.items()
+        }
+
+
+metrics = Metrics()
+
+requests_total = metrics.counter(
+    'messenger_requests_total', 'Received requests', ('action',)
+)
+responses_total = metrics.counter(
+    'messenger_responses_total', 'Sent responses by code', ('action', 'code')
+)
+bytes_received = metrics.counter(
+    'messenger_received_bytes_total', 'Bytes read from clients'
+)
+bytes_sent = metrics.counter(
+    'messenger_sent_bytes_total', 'Bytes written to clients'
+)
+active_connections = metrics.gauge(
+    'messenger_active_connections', 'Opened client connections'
+)
+online_users = metrics.gauge(
+    'messenger_online_users', 'Logged in users'
+)
+requests_in_flight = metrics.gauge(
+    'messenger_requests_in_flight', 'Requests processed by controllers'
+)
+shed_load = metrics.counter(
+    'messenger_shed_total',
+    'Connections and requests rejected because server is saturated',
+    ('reason',)
+)
+rate_limited = metrics.counter(
+    'messenger_rate_limited_total',
+    'Requests rejected by per connection and per user rate limits',
+    ('action',)
+)
+connections_memory = metrics.gauge(
+    'messenger_connections_memory_bytes',
+    'Approximate memory used by connections state and write buffers',
+    ('kind',)
+)
+request_latency = metrics.histogram(
+    'messenger_request_latency_seconds',
+    'Time from request receiving to response writing',
+    ('action',),
+    buckets=settings.LATENCY_BUCKETS
+)
+dropped_log_records = metrics.counter(
+    'messenger_dropped_log_records_total',
+    'Log records dropped because logging queue was full'
+)
@@ -1,16 +1,46 @@
 import re
 from abc import ABC
 from hashlib import pbkdf2_hmac
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
 
 from settings import MONGO_CREDENTIALS, SALT
+from tracing import tracer
+from deadlines import check as check_deadline
 
 
 client = MongoClient(**MONGO_CREDENTIALS)
 db = client.messenger
 
 
+class TracedCollection:
+    """
+    Proxy for pymongo collection.
+    Wraps every collection method call into tracer span
+    named like '<collection>.<method>'.
+    Calls made after request deadline raise 'DeadlineExceeded', so
+    timed out controllers stop loading database.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+
+        if not callable(attribute):
+            return attribute
+
+        def traced(*args, **kwargs):
+            check_deadline()
+            span_name = '{}.{}'.format(self.collection.name, name)
+            with tracer.span(span_name, category='mongo'):
+                return attribute(*args, **kwargs)
+
+        return traced
+
+
 class Core(ABC):
     """Provide default functionality for ancestors"""
 
@@ -85,7 +115,7 @@ class Core(ABC):
 
 class User(Core):
 
-    collection = db.users
+    collection = TracedCollection(db.users)
 
     fields = (
         '_id',
@@ -122,8 +152,47 @@ class User(Core):
         if user_doc:
             return cls(**user_doc)
 
-    def set_auth_state(self, state):
-        self.update(is_authenticate=state)
+    @classmethod
+    def get_user_with_contacts(cls, username):
+        """
+        Returns user and his contacts {username: id} fetched with one
+        aggregation: user is found by (unique indexed) username first,
+        then only usernames and ids of contacts are joined to him.
+        Returns (None, {}) if user does not exist.
+        """
+        result = cls.collection.aggregate(
+            [
+                {'$match': {'username': username}},
+                {'$limit': 1},
+                {
+                    '$lookup': {
+                        'from': 'users',
+                        'localField': 'contacts',
+                        'foreignField': '_id',
+                        'as': 'contacts_objects'
+                    }
+                },
+                {
+                    '$project': {
+                        'username': 1,
+                        'password': 1,
+                        'avatar': 1,
+                        'contacts': 1,
+                        'contacts_objects._id': 1,
+                        'contacts_objects.username': 1,
+                    }
+                }
+            ]
+        )
+
+        for user_doc in result:
+            contacts = {
+                contact['username']: contact['_id'].binary.hex()
+                for contact in user_doc.pop('contacts_objects')
+            }
+            return cls(**user_doc), contacts
+
+        return None, {}
 
     def release_password(self, password):
         return pbkdf2_hmac(
@@ -136,6 +205,7 @@ class User(Core):
     def get_contacts(self):
         result = self.collection.aggregate(
             [
+                {'$match': {'_id': self._id}},
                 {
                     '$lookup': {
                         'from': 'users',
@@ -144,7 +214,6 @@ class User(Core):
                         'as': 'contacts_objects'
                     }
                 },
-                {'$match': {'_id': self._id}},
                 {'$project': {'_id': 0, 'contacts_objects': 1}},
                 {'$unwind': '$contacts_objects'}
             ]
@@ -204,18 +273,19 @@ class User(Core):
 
 class Chat(Core):
 
-    collection = db.chats
+    collection = TracedCollection(db.chats)
 
     fields = (
         '_id',
         'chat_type',
         'participants',
-        'messages'
+        'messages',
+        'seq'
     )
 
     def __init__(self, **kwargs):
         if '_id' not in kwargs:
-            kwargs.update({'messages': [], 'participants': []})
+            kwargs.update({'messages': [], 'participants': [], 'seq': 0})
         super().__init__(**kwargs)
 
     @classmethod
@@ -243,55 +313,286 @@ class Chat(Core):
         )
         self.participants.append(participant._id)
 
-    def add_message(self, message):
-        """Adds message to chat"""
-        self.collection.update_one(
-            {'_id': self._id}, {'$push': {'messages': message._id}}
+    def add_message(self, message, once=False):
+        """
+        Adds message to chat and returns its sequence number.
+        Numbers grow by one in every chat, message seq is its position
+        in chat + 1 (counter and messages are updated at once).
+        With 'once' message is not added if it is in chat already
+        (returns None then).
+        """
+        query = {'_id': self._id}
+        if once:
+            query.update({'messages': {'$ne': message._id}})
+
+        chat_doc = self.collection.find_one_and_update(
+            query,
+            {'$push': {'messages': message._id}, '$inc': {'seq': 1}},
+            projection={'seq': 1},
+            return_document=ReturnDocument.AFTER
         )
+        if not chat_doc:
+            return None
+
         self.messages.append(message._id)
+        self.seq = chat_doc['seq']
+        return self.seq
+
+    def get_seq(self, message_id):
+        """Returns seq of chat message or None if it is not in chat"""
+        result = list(
+            self.collection.aggregate(
+                [
+                    {'$match': {'_id': self._id}},
+                    {
+                        '$project': {
+                            'position': {
+                                '$indexOfArray': ['$messages', message_id]
+                            }
+                        }
+                    }
+                ]
+            )
+        )
+        if result and result[0]['position'] >= 0:
+            return result[0]['position'] + 1
 
-    def get_messages(self):
-        result = self.collection.aggregate(
+    @staticmethod
+    def load_messages(ids):
+        """
+        Returns {message id: (username, text)} of given messages,
+        username of deleted sender is None and deleted message is
+        (None, None), so positions (seq) of following messages are kept
+        """
+        if not ids:
+            return {}
+
+        records = Message.collection.aggregate(
             [
+                {'$match': {'_id': {'$in': ids}}},
                 {
                     '$lookup': {
-                        'from': 'messages',
-                        'localField': 'messages',
+                        'from': 'users',
+                        'localField': 'sender_id',
                         'foreignField': '_id',
-                        'as': 'message_objects'
+                        'as': 'sender'
                     }
                 },
-                {'$match': {'_id': self._id}},
-                {'$project': {'_id': 0, 'message_objects': 1}},
-                {'$unwind': '$message_objects'}
+                {'$project': {'text': 1, 'sender.username': 1}}
             ]
         )
-        result = [
-            (
-                User.get_by_id(
-                    record['message_objects']['sender_id']
-                ).username, record['message_objects']['text']
+        messages = {
+            record['_id']: (
+                record['sender'][0]['username'] if record['sender']
+                else None,
+                record.get('text')
             )
-            for record in result
+            for record in records
+        }
+        return {_id: messages.get(_id, (None, None)) for _id in ids}
+
+    def get_messages(self, offset=0, limit=None):
+        """
+        Returns (username, text) of chat messages starting from given
+        position, so client can fetch only messages it does not have
+        """
+        ids = self.messages[offset:]
+        if limit is not None:
+            ids = ids[:limit]
+        messages = self.load_messages(ids)
+        return [messages[_id] for _id in ids]
+
+    @classmethod
+    def get_updates(cls, known, participant_id, limit):
+        """
+        Returns messages added to user chats after known sequence
+        numbers {chat_id: seq}, not more than 'limit' messages:
+        {chat_id: {'seq': last seq, 'messages': [(seq, username, text)]}}
+        and flag showing that some messages did not fit.
+        """
+        chat_docs = cls.collection.find(
+            {
+                '_id': {'$in': [ObjectId(chat_id) for chat_id in known]},
+                'participants': participant_id
+            },
+            {'seq': 1}
+        )
+        behind = [
+            chat_doc for chat_doc in chat_docs
+            if chat_doc.get('seq', 0) > known[chat_doc['_id'].binary.hex()]
         ]
-        return result
+
+        slices = {}
+        more = False
+
+        for chat_doc in behind:
+            if limit <= 0:
+                more = True
+                break
+
+            chat_id = chat_doc['_id'].binary.hex()
+            seq = known[chat_id]
+            ids = cls.collection.find_one(
+                {'_id': chat_doc['_id']},
+                {'messages': {'$slice': [seq, limit]}}
+            )['messages']
+
+            slices[chat_id] = (chat_doc['seq'], seq, ids)
+            limit -= len(ids)
+            more = more or seq + len(ids) < chat_doc['seq']
+
+        messages = cls.load_messages(
+            [_id for _, _, ids in slices.values() for _id in ids]
+        )
+        updates = {
+            chat_id: {
+                'seq': last_seq,
+                'messages': [
+                    (seq + number, *messages[_id])
+                    for number, _id in enumerate(ids, 1)
+                ]
+            }
+            for chat_id, (last_seq, seq, ids) in slices.items()
+        }
+        return updates, more
 
     def search_messages(self, text):
         messages = self.get_messages()
         return [
             message for message in messages if re.search(
-                text, message[1], flags=re.IGNORECASE
+                text, message[1] or '', flags=re.IGNORECASE
             )
         ]
 
 
 class Message(Core):
 
-    collection = db.messages
+    collection = TracedCollection(db.messages)
 
     fields = (
         '_id',
         'sender_id',
         'chat_id',
         'text',
+        'client_id',
+    )
+
+    @classmethod
+    def get_or_create(cls, **kwargs):
+        """
+        Creates message, if message with the same sender and client
+        message id ('client_id') exists returns it instead.
+        Returns message and True if it was created.
+        """
+        try:
+            return cls(**kwargs), True
+        except DuplicateKeyError:
+            message_doc = cls.collection.find_one(
+                {
+                    'sender_id': kwargs['sender_id'],
+                    'client_id': kwargs['client_id']
+                }
+            )
+            return cls(**message_doc), False
+
+
+class Delivery(Core):
+    """
+    Private message waiting for acknowledgement of recipient. It is
+    pushed to online recipient and in batches after login, recipient
+    acknowledges messages of chat when reads them (opens chat).
+    """
+
+    collection = TracedCollection(db.deliveries)
+
+    fields = (
+        '_id',
+        'user_id',
+        'chat_id',
+        'seq',
+        'message_id',
     )
+
+    @classmethod
+    def enqueue(cls, user_id, chat_id, seq, message_id):
+        """
+        Adds delivery of message if it is not added yet, so retried
+        message does not create second one
+        """
+        try:
+            cls.collection.update_one(
+                {'user_id': user_id, 'chat_id': chat_id, 'seq': seq},
+                {'$setOnInsert': {'message_id': message_id}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # concurrent retry inserted it (unique index)
+            pass
+
+    @classmethod
+    def get_batch(cls, user_id, limit, after=None):
+        """
+        Returns not more than 'limit' oldest not acknowledged messages
+        of user (after message with id 'after' if it is given), id of
+        last of them as 'cursor' for next batch and numbers of all of
+        them in every chat (unread counts)
+        """
+        unread = {
+            record['_id'].binary.hex(): record['count']
+            for record in cls.collection.aggregate(
+                [
+                    {'$match': {'user_id': user_id}},
+                    {'$group': {'_id': '$chat_id', 'count': {'$sum': 1}}}
+                ]
+            )
+        }
+        if not unread:
+            return {
+                'messages': [], 'unread': {}, 'cursor': after, 'more': False
+            }
+
+        query = {'user_id': user_id}
+        if after:
+            query['message_id'] = {'$gt': ObjectId(after)}
+
+        # message ids grow with time, one more is read to know
+        # whether next batch exists
+        deliveries = list(
+            cls.collection.find(query).sort('message_id', 1).limit(limit + 1)
+        )
+        more = len(deliveries) > limit
+        deliveries = deliveries[:limit]
+        messages = Chat.load_messages(
+            [delivery['message_id'] for delivery in deliveries]
+        )
+
+        return {
+            'messages': [
+                {
+                    'chat_id': delivery['chat_id'].binary.hex(),
+                    'seq': delivery['seq'],
+                    'message': messages[delivery['message_id']]
+                }
+                for delivery in deliveries
+            ],
+            'unread': unread,
+            'cursor': (
+                deliveries[-1]['message_id'].binary.hex() if deliveries
+                else after
+            ),
+            'more': more
+        }
+
+    @classmethod
+    def acknowledge(cls, user_id, chats):
+        """Deletes deliveries of chats up to given seq {chat_id: seq}"""
+        if chats:
+            cls.collection.delete_many(
+                {
+                    'user_id': user_id,
+                    '$or': [
+                        {'chat_id': ObjectId(chat_id), 'seq': {'$lte': seq}}
+                        for chat_id, seq in chats.items()
+                    ]
+                }
+            )
@@ -1,3 +1,4 @@
+import threading
 from abc import ABC, abstractmethod
 from typing import Dict
 from logging import getLogger
@@ -6,6 +7,30 @@ from logging import getLogger
 logger = getLogger('server_logger')
 
 
+class Lazy:
+    """
+    Notification payload which is evaluated on first call only.
+    Allows to skip expensive payload preparing when nobody uses it.
+    """
+
+    __slots__ = ('function', 'value', 'evaluated')
+
+    def __init__(self, function) -> None:
+        self.function = function
+        self.evaluated = False
+
+    def __call__(self):
+        if not self.evaluated:
+            self.value = self.function()
+            self.evaluated = True
+        return self.value
+
+
+def resolve(value):
+    """Returns evaluated value if passed value is lazy payload"""
+    return value() if isinstance(value, Lazy) else value
+
+
 class Notifier(ABC):
     """Notifier interface"""
 
@@ -52,7 +77,8 @@ class BaseNotifier(Notifier):
 
         if event in self._listeners:
             self._listeners[event].append(listener)
-        self._listeners[event] = [listener]
+        else:
+            self._listeners[event] = [listener]
 
     def remove_listener(self, event: str, listener: 'Listener') -> None:
         """Remove listener from notifier"""
@@ -63,7 +89,11 @@ class BaseNotifier(Notifier):
             self._listeners.pop(event)
 
     def notify(self, event: str, *args, **kwargs) -> None:
-        """Notify every listener about changed state"""
+        """
+        Notify every listener about changed state.
+        Payloads can be passed as 'Lazy' objects, they are evaluated
+        by listeners only when needed.
+        """
 
         if event in self._listeners:
             for listener in self._listeners[event]:
@@ -109,28 +139,69 @@ class ServerStatusListener(Listener):
                         widget.setReadOnly(False)
 
 
-class LogListener(Listener):
+class ThrottledListener(Listener):
+    """
+    Keeps only last received payload.
+    Payload is emitted to widget by 'flush' method which is called by
+    timer from gui thread, so widget is updated not often than timer ticks
+    and lazy payloads are evaluated only for updates really shown.
+    """
+
+    key: str
+
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.Lock()
+        self.pending = None
+        super().__init__(*args, **kwargs)
 
     def refresh(self, notifier: Notifier, *args, **kwargs) -> None:
-        log = kwargs.get('info')
-        if log:
-            self.employer.append_log.emit(log)
+        payload = kwargs.get(self.key)
+        if payload:
+            with self.lock:
+                self.pending = payload
 
+    def flush(self) -> None:
+        with self.lock:
+            payload, self.pending = self.pending, None
 
-class RequestListener(Listener):
+        if payload:
+            self.emit(resolve(payload))
 
-    def refresh(self, notifier: Notifier, *args, **kwargs) -> None:
-        request = kwargs.get('request')
-        if request:
-            self.employer.write_request.emit(request)
+    def emit(self, payload) -> None:
+        pass
 
 
-class ResponseListener(Listener):
+class LogListener(ThrottledListener):
+    """Collects log lines and emits them as one batch"""
+
+    key = 'info'
 
     def refresh(self, notifier: Notifier, *args, **kwargs) -> None:
-        response = kwargs.get('response')
-        if response:
-            self.employer.write_response.emit(response)    
+        log = kwargs.get(self.key)
+        if log:
+            with self.lock:
+                if self.pending is None:
+                    self.pending = []
+                self.pending.append(log)
+
+    def emit(self, payload) -> None:
+        self.employer.append_log.emit('\n'.join(map(resolve, payload)))
+
+
+class RequestListener(ThrottledListener):
+
+    key = 'request'
+
+    def emit(self, payload) -> None:
+        self.employer.write_request.emit(payload)
+
+
+class ResponseListener(ThrottledListener):
+
+    key = 'response'
+
+    def emit(self, payload) -> None:
+        self.employer.write_response.emit(payload)
 
 
 class ClientListener(Listener):
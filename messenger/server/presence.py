@@ -0,0 +1,66 @@
+import os
+import json
+import time
+from typing import Dict, List
+
+
+class Presence:
+    """
+    In-memory registry of online users, the only source of truth
+    about who is online on this server: {username: {session, ...}}.
+    Session is any hashable object (client connection), user is
+    online while at least one of sessions is alive.
+    """
+
+    def __init__(self) -> None:
+        self.sessions: Dict = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, username):
+        return username in self.sessions
+
+    def add(self, username: str, session) -> bool:
+        """Adds user session, returns True if user came online"""
+
+        sessions = self.sessions.setdefault(username, set())
+        sessions.add(session)
+        return len(sessions) == 1
+
+    def remove(self, username: str, session) -> bool:
+        """Removes user session, returns True if user went offline"""
+
+        sessions = self.sessions.get(username)
+        if not sessions or session not in sessions:
+            return False
+
+        sessions.discard(session)
+        if not sessions:
+            del self.sessions[username]
+            return True
+        return False
+
+    def is_online(self, username: str) -> bool:
+        return username in self.sessions
+
+    def users(self) -> List:
+        return list(self.sessions)
+
+    def snapshot(self) -> Dict:
+        return {
+            'time': time.time(),
+            'users': {
+                username: len(sessions)
+                for username, sessions in self.sessions.items()
+            }
+        }
+
+    @staticmethod
+    def save(snapshot: Dict, path: str) -> None:
+        """Writes snapshot to file, file is replaced at once"""
+
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(temp_path, path)
@@ -0,0 +1,101 @@
+import time
+from typing import Dict
+
+import settings
+
+
+class TokenBucket:
+    """
+    Bucket with 'capacity' tokens refilled with 'rate' tokens per second.
+    Every request takes one token, request is allowed if bucket is not empty.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def consume(self, amount: float = 1) -> bool:
+        self.refill(time.monotonic())
+
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Keeps token buckets for (connection, action) and (username, action).
+    Requests of not logged in connection (login, register) use bucket
+    of username named in request and bucket of client host, so new
+    connection does not give new burst. Connection buckets live in
+    connection state and go away with it, user and host buckets are
+    pruned when they are refilled completely.
+    """
+
+    def __init__(self) -> None:
+        self.users: Dict = {}
+
+    @staticmethod
+    def bucket(buckets: Dict, key, limit: Dict) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(
+                limit['rate'], limit['burst']
+            )
+        return bucket
+
+    def allow(
+            self, connection, action: str, limit: Dict, username=None
+    ) -> bool:
+        """
+        Returns True if request with action is allowed for connection
+        and for user logged in with it (or named in request 'username'
+        and host of connection if connection is not logged in).
+        limit - {'rate': tokens per second, 'burst': bucket capacity}
+        """
+
+        if not self.bucket(connection.buckets, action, limit).consume():
+            return False
+
+        if connection.username:
+            key = (connection.username, action)
+            return self.bucket(self.users, key, limit).consume()
+
+        if connection.address:
+            # clients behind one address (NAT) share host bucket
+            factor = settings.RATE_LIMIT_HOST_FACTOR
+            host_limit = {
+                'rate': limit['rate'] * factor,
+                'burst': limit['burst'] * factor
+            }
+            key = (('host', connection.address[0]), action)
+            if not self.bucket(self.users, key, host_limit).consume():
+                return False
+
+        if isinstance(username, str):
+            return self.bucket(self.users, (username, action), limit).consume()
+
+        return True
+
+    def prune(self) -> None:
+        """Removes user buckets which are full (users not active)"""
+
+        now = time.monotonic()
+        for key, bucket in list(self.users.items()):
+            if bucket.is_full(now):
+                del self.users[key]
@@ -0,0 +1,98 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from typing import Dict
+
+import settings
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class SessionTokens:
+    """
+    Signed session tokens given to users after login, so they can
+    resume session on new connection without password checking.
+    Token is 'payload.signature', payload is json with username,
+    user id, expiration time and token id. Revoked token ids are kept
+    until tokens expire.
+    """
+
+    def __init__(self, secret: str, ttl: float) -> None:
+        self.secret = secret.encode()
+        self.ttl = ttl
+        self.revoked: Dict = {}
+        self.lock = threading.Lock()
+
+    def sign(self, payload: str) -> str:
+        return b64encode(
+            hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()
+        )
+
+    def issue(self, username: str, user_id: str) -> str:
+        payload = b64encode(
+            json.dumps(
+                {
+                    'username': username,
+                    'user_id': user_id,
+                    'expires': int(time.time() + self.ttl),
+                    'id': secrets.token_hex(8),
+                },
+                separators=(',', ':')
+            ).encode()
+        )
+        return '{}.{}'.format(payload, self.sign(payload))
+
+    def decode(self, token) -> Dict:
+        """Returns payload of token with valid signature or None"""
+
+        if not isinstance(token, str) or token.count('.') != 1:
+            return None
+
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(self.sign(payload), signature):
+            return None
+
+        try:
+            return json.loads(b64decode(payload))
+        except ValueError:
+            return None
+
+    def verify(self, token) -> Dict:
+        """Returns payload of valid, not expired and not revoked token"""
+
+        payload = self.decode(token)
+
+        if not payload or payload['expires'] < time.time():
+            return None
+
+        with self.lock:
+            if payload['id'] in self.revoked:
+                return None
+
+        return payload
+
+    def revoke(self, token) -> bool:
+        payload = self.decode(token)
+        if not payload:
+            return False
+
+        now = time.time()
+        with self.lock:
+            self.revoked[payload['id']] = payload['expires']
+            for token_id, expires in list(self.revoked.items()):
+                if expires < now:
+                    del self.revoked[token_id]
+        return True
+
+
+sessions = SessionTokens(settings.SESSION_SECRET, settings.SESSION_TTL)
@@ -1,5 +1,7 @@
 import os
 import json
+import secrets
+import tempfile
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -7,11 +9,112 @@ ENCODING_NAME = 'utf-8'
 BUFFER_SIZE = 65536
 HOST = 'localhost'
 PORT = 40000
-CONNECTIONS = 7
+# max number of simultaneously opened client connections
+CONNECTIONS = 1000
+# max number of requests processed by controllers at the same time,
+# requests over this limit are answered with 503 at once
+MAX_IN_FLIGHT = 16
+# seconds given to controller to process request if route
+# has no 'deadline' option, client can pass smaller 'timeout' seconds
+REQUEST_DEADLINE = 10
+# route rate limit of not logged in connections (login, register) is
+# also applied to client host, multiplied by this number
+RATE_LIMIT_HOST_FACTOR = 10
+
+# number of worker processes started by supervisor (1 - no supervisor),
+# workers share port and exchange messages via unix socket bus
+WORKERS = 1
+# exited worker is started again after delay (seconds) doubled from
+# MIN up to MAX while worker exits earlier than WORKER_STABLE_TIME
+# after start, supervisor stops if workers exit more than
+# WORKER_EXIT_LIMIT times within WORKER_EXIT_WINDOW seconds
+WORKER_RESTART_DELAY_MIN = 0.5
+WORKER_RESTART_DELAY_MAX = 30
+WORKER_STABLE_TIME = 60
+WORKER_EXIT_LIMIT = 10
+WORKER_EXIT_WINDOW = 60
+# '{port}' is replaced by port server listens on
+BUS_PATH = os.path.join(tempfile.gettempdir(), 'messenger_bus_{port}.sock')
+
+# cluster of server nodes, every node links to all CLUSTER_PEERS
+# {node name: (host, port)} and accepts their links on CLUSTER_PORT,
+# empty CLUSTER_PEERS - no cluster (can't be used with WORKERS > 1)
+NODE_NAME = 'node-{}'.format(PORT)
+CLUSTER_HOST = HOST
+CLUSTER_PORT = 41000
+CLUSTER_PEERS = {}
+# seconds between attempts to open lost link to peer (doubled every time)
+CLUSTER_RETRY_MIN = 0.5
+CLUSTER_RETRY_MAX = 10
+# seconds 'hello' of node link is valid, links are authenticated with
+# SESSION_SECRET signature, so clocks of nodes must be close
+CLUSTER_HELLO_MAX_AGE = 60
+
+# seconds of connection silence before server sends 'ping'
+HEARTBEAT_INTERVAL = 30
+# seconds of connection silence before server drops it
+IDLE_TIMEOUT = 90
+
+# seconds between writing users online to PRESENCE_SNAPSHOT_FILE
+# ({worker} is replaced with worker number), None - no snapshots
+PRESENCE_SNAPSHOT_INTERVAL = None
+PRESENCE_SNAPSHOT_FILE = os.path.join(
+    BASE_DIR, 'log', 'presence_{worker}.json'
+)
+
+# logging records are written to file by background thread,
+# records are dropped when queue is full
+LOG_QUEUE_SIZE = 10000
+# '{worker}' is replaced by '_N' in process of worker N
+LOG_FILE = os.path.join(BASE_DIR, 'log', 'server_log{worker}.log')
+# 'text' or 'json' (one json object per line)
+LOG_FORMAT = 'text'
+# fraction of request/response bodies written to log
+LOG_PAYLOAD_SAMPLE_RATE = 1
+# max length of logged request/response body, None - no limit
+LOG_PAYLOAD_LIMIT = 2048
+# values of these fields (nested ones too) are hidden in logged bodies
+LOG_SECRET_FIELDS = ('password', 'token', 'admin_token')
+
+# milliseconds between server gui log/request/response widgets updates
+GUI_REFRESH_INTERVAL = 250
+
+TRACING = False
+# '{worker}' is replaced by '_N' in process of worker N
+TRACE_FILE = os.path.join(BASE_DIR, 'log', 'trace{worker}.json')
+TRACE_BUFFER_SIZE = 100000
+
+METRICS_PORT = 40001
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+# secret required in 'admin_token' field of [admin] app requests,
+# empty value disables these actions
+ADMIN_TOKEN = os.environ.get('MESSENGER_ADMIN_TOKEN', '')
+
+# key signing session tokens given after login ('resume' action),
+# must be the same on all cluster nodes, random key makes tokens
+# invalid after restart
+SESSION_SECRET = os.environ.get(
+    'MESSENGER_SESSION_SECRET', secrets.token_hex(32)
+)
+# seconds session token is valid
+SESSION_TTL = 7 * 24 * 3600
+
+# max number of messages in one 'sync' response
+SYNC_PAGE_SIZE = 500
+# max number of not acknowledged private messages sent after login
+# or in 'deliveries' response
+DELIVERY_BATCH_SIZE = 100
+# number of recently added messages remembered by their client
+# message ids, retries of them are answered without database writes
+MESSAGE_DEDUP_CACHE_SIZE = 10000
 
 INSTALLED_MODULES = [
     'auth',
-    'chat'
+    'chat',
+    'admin'
 ]
 
 with open(os.path.join(BASE_DIR, 'credentials.json')) as file:
@@ -0,0 +1,170 @@
+import os
+import time
+import signal
+import asyncio
+from collections import deque
+from logging import getLogger
+
+import settings
+from bus import BusHub
+from logs import stop_logging, use_worker_log_file
+
+
+logger = getLogger('server_logger')
+
+
+def interrupt(signum, frame):
+    """Turns SIGTERM into KeyboardInterrupt so worker closes gracefully"""
+    raise KeyboardInterrupt()
+
+
+class Supervisor:
+    """
+    Forks worker processes, each of them runs own server sharing
+    listening port with others (SO_REUSEPORT). Workers exchange
+    presence and messages through bus hub running in supervisor.
+    Dead workers are started again, worker exiting soon after start
+    waits longer before every next start (exponential backoff).
+    Supervisor stops when workers exit too often.
+    """
+
+    def __init__(self, server_factory, workers: int, bus_path: str) -> None:
+        self.server_factory = server_factory
+        self.workers = workers
+        self.bus_path = bus_path
+        self.children = {}
+        self.started = {}
+        self.delays = {}
+        self.pending = {}
+        self.exits = deque()
+        self.stopping = False
+
+    def run(self) -> None:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        loop = asyncio.get_event_loop()
+
+        self.hub = BusHub(self.bus_path)
+        loop.run_until_complete(self.hub.start())
+
+        for worker in range(self.workers):
+            self.spawn(worker)
+
+        loop.add_signal_handler(signal.SIGCHLD, self.reap)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+
+        logger.info('Supervisor started %s workers', self.workers)
+
+        try:
+            loop.run_forever()
+        finally:
+            self.hub.close()
+            loop.close()
+
+    def spawn(self, worker: int) -> None:
+        pid = os.fork()
+
+        if pid:
+            self.children[pid] = worker
+            self.started[worker] = time.monotonic()
+            return
+
+        # worker process: drop supervisor signal handling
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, interrupt)
+        signal.signal(signal.SIGTERM, interrupt)
+
+        status = 0
+        try:
+            # rotating log file must not be shared with other processes
+            use_worker_log_file(worker)
+            server = self.server_factory()
+            server.worker = worker
+            server.run()
+        except Exception:
+            logger.critical('Worker %s failed', worker, exc_info=True)
+            status = 1
+        finally:
+            # worker must not return to supervisor code, atexit
+            # handlers are not called, so log queue is flushed here,
+            # SIGTERM can interrupt flushing of crashed worker
+            try:
+                stop_logging()
+            finally:
+                os._exit(status)
+
+    def reap(self) -> None:
+        """Collects exited workers and starts new ones instead of them"""
+
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+
+            worker = self.children.pop(pid, None)
+            if worker is None:
+                continue
+
+            logger.warning(
+                'Worker %s (pid %s) exited with status %s', worker, pid, status
+            )
+            if not self.stopping:
+                self.restart(worker)
+
+        if self.stopping and not self.children:
+            asyncio.get_event_loop().stop()
+
+    def restart(self, worker: int) -> None:
+        """
+        Schedules start of exited worker. Delay is doubled every time
+        worker exits earlier than WORKER_STABLE_TIME after start.
+        """
+
+        now = time.monotonic()
+        self.exits.append(now)
+        while self.exits[0] < now - settings.WORKER_EXIT_WINDOW:
+            self.exits.popleft()
+
+        if len(self.exits) > settings.WORKER_EXIT_LIMIT:
+            logger.critical(
+                'Workers exited %s times within %s seconds, stopping',
+                len(self.exits), settings.WORKER_EXIT_WINDOW
+            )
+            self.stop()
+            return
+
+        uptime = now - self.started.pop(worker, now)
+        if uptime >= settings.WORKER_STABLE_TIME:
+            delay = 0
+        else:
+            delay = min(
+                settings.WORKER_RESTART_DELAY_MAX,
+                self.delays.get(worker, 0) * 2
+                or settings.WORKER_RESTART_DELAY_MIN
+            )
+        self.delays[worker] = delay
+
+        if delay:
+            logger.warning('Worker %s is started in %s s', worker, delay)
+        self.pending[worker] = asyncio.get_event_loop().call_later(
+            delay, self.start_pending, worker
+        )
+
+    def start_pending(self, worker: int) -> None:
+        del self.pending[worker]
+        self.spawn(worker)
+
+    def stop(self) -> None:
+        self.stopping = True
+
+        for handle in self.pending.values():
+            handle.cancel()
+        self.pending.clear()
+
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+
+        if not self.children:
+            asyncio.get_event_loop().stop()
+
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+
+import settings
+
+
+logger = getLogger('server_logger')
+
+current_request = ContextVar('current_request', default=None)
+
+
+class Tracer:
+    """
+    Collects timed spans of request processing phases.
+    Spans are kept in bounded in-memory buffer and exported to file in
+    'Trace Event Format' (chrome://tracing, Perfetto, speedscope).
+    """
+
+    enabled = settings.TRACING
+    path = settings.TRACE_FILE
+    buffer_size = settings.TRACE_BUFFER_SIZE
+    # worker number, workers write own trace files
+    worker = None
+
+    def __init__(self) -> None:
+        self.events = deque(maxlen=self.buffer_size)
+        self.pid = os.getpid()
+
+    def start_request(self, request_id: str = None) -> str:
+        """
+        Binds new request id to current execution context,
+        all spans recorded in this context are marked with it.
+        """
+        request_id = request_id or uuid.uuid4().hex
+        current_request.set(request_id)
+        return request_id
+
+    @contextmanager
+    def span(self, name: str, category: str = 'server', **kwargs):
+        """Records duration of code executed within 'with' block"""
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.record(name, category, start, duration, **kwargs)
+
+    def record(self, name, category, start, duration, **kwargs) -> None:
+        """Adds complete ('X' phase) event to buffer"""
+
+        kwargs.update({'request_id': current_request.get()})
+        self.events.append(
+            {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int(duration * 1e6),
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+                'args': kwargs,
+            }
+        )
+
+    def export(self, path: str = None) -> str:
+        """
+        Writes buffered events to file in 'Trace Event Format'
+        and clears buffer. Returns path of written file.
+        """
+        path = path or self.path.format(
+            worker='' if self.worker is None else '_{}'.format(self.worker)
+        )
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events}, file)
+
+        logger.info('Trace with {} spans exported to {}'.format(
+            len(events), path
+        ))
+        return path
+
+
+tracer = Tracer()